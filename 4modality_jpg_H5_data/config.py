@@ -18,11 +18,20 @@ MODALITY = 't1'
 
 IMG_MODE = 'reg'
 
+# step1 'norm' / 'n4' normalization : brain-only statistics, per slice percentile clipping
+NORM_BRAIN_MASK = False
+NORM_CLIP_PCT = None  # e.g. (0.5, 99.5)
+
+# step1 ingestion pool : 1 -> serial, None -> one worker per core
+INGEST_WORKERS = 1
+
 TASK = 'all'
 
 
 # For step2_write_tfrecord
 TF_IMG_SRC = './BRATS/HGG/t1/reg_JPG/*'
+# write records while reading, train / test split assigned on the file list
+STREAM_TFRECORDS = True
 
 
 """ AFFECTS HOW CODE RUNS"""
@@ -126,3 +135,12 @@ ORIG_SIZE = 184
 IMAGE_SIZE = 184
 N_EPOCHS = FLAGS.num_epochs
 TEST_SPLIT = 0.2
+
+# patient level split, see split_manifest. TEST_SPLIT = 1 / N_FOLDS
+N_FOLDS = int(round(1 / TEST_SPLIT))
+TEST_FOLD = 0
+TRAIN_FOLDS = None  # None -> every fold but TEST_FOLD
+SPLIT_SEED = 42
+SPLIT_MANIFEST = './record/split_manifest.json'
+# NIfTI dir name of every patient number, written by step1
+PATIENT_INDEX = './BRATS/patients.json'
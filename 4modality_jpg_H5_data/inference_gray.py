@@ -7,6 +7,8 @@ FLAGS = tf.app.flags.FLAGS
 def unpool_with_argmax(pool, ind, name=None, ksize=[1, 2, 2, 1]):
     """
        Unpooling layer after max_pool_with_argmax.
+       Works for any batch size : the batch dimension (and the spatial ones, if
+       unknown) are read from the tensor at run time instead of FLAGS.batch_size.
        Args:
            pool:   max pooled output tensor
            ind:      argmax indices
@@ -14,21 +16,20 @@ def unpool_with_argmax(pool, ind, name=None, ksize=[1, 2, 2, 1]):
        Return:
            unpool:    unpooling tensor
     """
-    tmp_batch_size = FLAGS.batch_size
     with tf.variable_scope(name):
-        input_shape = pool.get_shape().as_list()
-        output_shape = (tmp_batch_size,
+        input_shape = tf.shape(pool, out_type=ind.dtype)
+        output_shape = [input_shape[0],
                         input_shape[1] * ksize[1],
                         input_shape[2] * ksize[2],
-                        input_shape[3])
+                        input_shape[3]]
 
-        flat_input_size = np.prod(input_shape[1:]) * tmp_batch_size
-        flat_output_shape = [output_shape[0],
-                             output_shape[1] * output_shape[2] * output_shape[3]]
+        flat_input_size = tf.reduce_prod(input_shape)
+        flat_output_shape = tf.stack([output_shape[0],
+                                      output_shape[1] * output_shape[2] * output_shape[3]])
 
         pool_ = tf.reshape(pool, [flat_input_size])
         batch_range = tf.reshape(tf.range(output_shape[0], dtype=ind.dtype),
-                                 shape=[tmp_batch_size, 1, 1, 1])
+                                 shape=[-1, 1, 1, 1])
 
         b = tf.ones_like(ind) * batch_range
         b = tf.reshape(b, [flat_input_size, 1])
@@ -36,7 +37,14 @@ def unpool_with_argmax(pool, ind, name=None, ksize=[1, 2, 2, 1]):
         ind_ = tf.concat([b, ind_], 1)
 
         ret = tf.scatter_nd(ind_, pool_, shape=flat_output_shape)
-        ret = tf.reshape(ret, output_shape)
+        ret = tf.reshape(ret, tf.stack(output_shape))
+
+        # keep whatever is known statically, the conv layers need the channels
+        static_shape = pool.get_shape().as_list()
+        ret.set_shape([static_shape[0],
+                       static_shape[1] * ksize[1] if static_shape[1] is not None else None,
+                       static_shape[2] * ksize[2] if static_shape[2] is not None else None,
+                       static_shape[3]])
         return ret
 
 
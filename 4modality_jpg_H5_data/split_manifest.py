@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function, absolute_import
+import os
+import json
+import glob
+import numpy as np
+
+import config
+
+
+def patient_of(slice_id):
+    # {n}_{slice}.jpg -> '{n}'
+    return os.path.basename(slice_id).split('_')[0]
+
+
+def patient_name(patient_dir):
+    # './BraTS17/HGG/Brats17_TCIA_105_1/' -> 'Brats17_TCIA_105_1'
+    return os.path.basename(os.path.normpath(patient_dir))
+
+
+def write_patient_index(patient_dirs, path=config.PATIENT_INDEX):
+    '''
+    step1 numbers the patients in the order of patient_dirs : records the NIfTI
+    dir name of every patient number, {'{n}': name}
+    '''
+    index = dict((str(n), patient_name(d)) for n, d in enumerate(patient_dirs))
+    dst_dir = os.path.dirname(path)
+    if dst_dir and not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    with open(path, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+
+def read_patient_index(path=config.PATIENT_INDEX):
+    '''
+    the {'{n}': name} written by step1, None for data written before it kept one
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def build_manifest(patient_ids, n_folds=config.N_FOLDS, seed=config.SPLIT_SEED, names=None):
+    '''
+    assigns every patient to one of n_folds folds, round robin over a seeded
+    permutation of the sorted patient ids. names: the patient index, its
+    patients' NIfTI dir names are kept with the folds
+    '''
+    patients = sorted(set(patient_ids))
+    if len(patients) < n_folds:
+        raise ValueError("{} patients can not fill {} folds".format(len(patients), n_folds))
+    order = np.random.RandomState(seed).permutation(len(patients))
+    folds = dict((patients[p], int(n % n_folds)) for n, p in enumerate(order))
+    manifest = {'n_folds': n_folds, 'seed': seed, 'folds': folds}
+    if names is not None:
+        manifest['names'] = dict((p, names[p]) for p in patients)
+    return manifest
+
+
+def load_or_create_manifest(slice_ids, path=config.SPLIT_MANIFEST,
+                            n_folds=config.N_FOLDS, seed=config.SPLIT_SEED,
+                            index_path=config.PATIENT_INDEX):
+    '''
+    reuses the manifest at path when it was built with the same n_folds / seed
+    and knows every patient in slice_ids under the same NIfTI dir name,
+    otherwise builds and saves a new one
+    '''
+    patient_ids = set(patient_of(i) for i in slice_ids)
+    names = read_patient_index(index_path)
+    if names is None:
+        print('No patient index at {}, patient numbers can not be checked '
+              'against their NIfTI dirs'.format(index_path))
+    else:
+        unnamed = patient_ids - set(names)
+        if unnamed:
+            raise ValueError("Patient index {} has no name for patients {}. "
+                             "Re-run step1.".format(index_path, sorted(unnamed)))
+
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest['n_folds'] != n_folds or manifest['seed'] != seed:
+            raise ValueError("Split manifest {} was built with n_folds={}, seed={}. "
+                             "Delete it to re-split.".format(path, manifest['n_folds'],
+                                                              manifest['seed']))
+        missing = patient_ids - set(manifest['folds'])
+        if missing:
+            raise ValueError("Split manifest {} has no fold for patients {}. "
+                             "Delete it to re-split.".format(path, sorted(missing)))
+        if names is not None and 'names' in manifest:
+            # the same number given to another patient by a later step1 run
+            renamed = [p for p in patient_ids if manifest['names'].get(p) != names[p]]
+            if renamed:
+                raise ValueError("Patients {} of split manifest {} are other patients in {}. "
+                                 "Delete it to re-split.".format(sorted(renamed), path, index_path))
+        print('Reusing split manifest ', path)
+        return manifest
+
+    manifest = build_manifest(patient_ids, n_folds, seed, names)
+    dst_dir = os.path.dirname(path)
+    if dst_dir and not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print('Split manifest written to ', path)
+    return manifest
+
+
+def folds_of(slice_ids, manifest):
+    return np.array([manifest['folds'][patient_of(i)] for i in slice_ids], dtype=np.int32)
+
+
+def split_masks(slice_ids, manifest, test_fold=config.TEST_FOLD, train_folds=None):
+    '''
+    returns boolean train / test masks over slice_ids. slices of one patient
+    always fall in the same set. train_folds=None trains on every other fold
+    '''
+    folds = folds_of(slice_ids, manifest)
+    if train_folds is None:
+        train_folds = [k for k in range(manifest['n_folds']) if k != test_fold]
+    if test_fold in train_folds:
+        raise ValueError("Fold {} can not be both train and test".format(test_fold))
+    return np.isin(folds, train_folds), folds == test_fold
+
+
+if __name__ == '__main__':
+
+    ids = sorted(os.path.basename(fl) for fl in glob.glob(config.TF_IMG_SRC))
+    manifest = load_or_create_manifest(ids)
+    folds = folds_of(ids, manifest)
+    for k in range(manifest['n_folds']):
+        print('fold {} : {} patients, {} slices'.format(
+            k, sum(1 for v in manifest['folds'].values() if v == k), np.sum(folds == k)))
@@ -9,11 +9,11 @@ import cv2
 import os
 import glob
 from sklearn.utils import shuffle
-from sklearn.model_selection import train_test_split
 
 
 import config
 import h5py
+import split_manifest
 
 
 def _int64_feature(value):
@@ -24,6 +24,19 @@ def _bytes_feature(value):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
 
+def _serialize_example(img, lbl, ID):
+
+    # Create a feature
+    feature = {
+        'train/image': _bytes_feature(tf.compat.as_bytes(img.tostring())),
+        'train/label': _bytes_feature(tf.compat.as_bytes(lbl.tostring())),
+        'train/id': _bytes_feature(tf.compat.as_bytes(ID))}
+
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
+
+    return example.SerializeToString()
+
+
 def write_record(imgs, lbls, IDs, tfrecord_name='./train.tfrecords', lbl='train'):
 
     writer = tf.python_io.TFRecordWriter(tfrecord_name)
@@ -34,21 +47,25 @@ def write_record(imgs, lbls, IDs, tfrecord_name='./train.tfrecords', lbl='train'
             print('{} data: {}/{}'.format(lbl, i, n_obs))
             sys.stdout.flush()
 
-        # Load the image
-        img = imgs[i, :, :, :]
-        lbl = lbls[i, :, :]
-        ID = IDs[i]
+        writer.write(_serialize_example(imgs[i, :, :, :], lbls[i, :, :], IDs[i]))
+        # print('done')
 
-        # Create a feature
-        feature = {
-            'train/image': _bytes_feature(tf.compat.as_bytes(img.tostring())),
-            'train/label': _bytes_feature(tf.compat.as_bytes(lbl.tostring())),
-            'train/id': _bytes_feature(tf.compat.as_bytes(ID))}
+    writer.close()
+    sys.stdout.flush()
 
-        example = tf.train.Example(features=tf.train.Features(feature=feature))
 
-        writer.write(example.SerializeToString())
-        # print('done')
+def write_record_stream(examples, n_obs, tfrecord_name='./train.tfrecords', lbl='train'):
+    '''
+    examples: iterable of (img, lbl, ID), serialized one at a time as it is consumed
+    '''
+    writer = tf.python_io.TFRecordWriter(tfrecord_name)
+
+    for i, (img, label, ID) in enumerate(examples):
+        if not i % 100:
+            print('{} data: {}/{}'.format(lbl, i, n_obs))
+            sys.stdout.flush()
+
+        writer.write(_serialize_example(img, label, ID))
 
     writer.close()
     sys.stdout.flush()
@@ -75,6 +92,43 @@ def binarize_targets(y_train):
     return y_train
 
 
+def read_example(fl):
+    '''
+    reads the 4 modality jpgs and the gt H5 of one slice, fl being its t1 jpg
+    returns image (184, 184, 4) float32, binarized label (184, 184) int32, ID
+    '''
+    mod_dict = dict((v, k) for k, v in config.MODALITY_DICT.iteritems())
+    tmp_name_list = fl.split('/')
+    mod_images = []
+    for j in range(4):
+        tmp_name_list[3] = mod_dict[j]
+        t_fl = "/".join(tmp_name_list)
+
+        # +++++++++++++++++++++++++ IMAGE +++++++++++++++++++++++++
+        image = cv2.imread(t_fl)
+        image = cv2.resize(image,
+                           (config.ORIG_SIZE, config.ORIG_SIZE),
+                           interpolation=cv2.INTER_LINEAR)
+        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        mod_images.append(gray_image)
+
+    img = np.stack(mod_images, axis=-1).astype(np.float32)
+
+    # +++++++++++++++++++++++++ LABEL +++++++++++++++++++++++++
+    tmp_name_list[3] = 'gt'
+    gt_fl = "/".join(tmp_name_list)
+    gt_fl = list(gt_fl)
+    gt_fl[-3:] = 'h5'
+    gt_fl = "".join(gt_fl)
+
+    h5f = h5py.File(gt_fl, 'r')
+    lbl = h5f['gt'][:]
+    lbl = binarize_targets(lbl).astype(np.int32)
+    h5f.close()
+
+    return img, lbl, os.path.basename(fl)
+
+
 def load_data(path, do_test=False):
     images = []
     labels = []
@@ -85,42 +139,12 @@ def load_data(path, do_test=False):
     files = glob.glob(path)
     files.sort()
     for fl in files:
-
-        mod_dict = dict((v, k) for k, v in config.MODALITY_DICT.iteritems())
-        tmp_name_list = fl.split('/')
-        mod_images = []
-        for j in range(4):
-            tmp_name_list[3] = mod_dict[j]
-            t_fl = "/".join(tmp_name_list)
-
-            # +++++++++++++++++++++++++ IMAGE +++++++++++++++++++++++++
-            image = cv2.imread(t_fl)
-            image = cv2.resize(image,
-                               (config.ORIG_SIZE, config.ORIG_SIZE),
-                               interpolation=cv2.INTER_LINEAR)
-            gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            mod_images.append(gray_image)
-
-        images.append(mod_images)
-
-        # +++++++++++++++++++++++++ LABEL +++++++++++++++++++++++++
-        tmp_name_list[3] = 'gt'
-        gt_fl = "/".join(tmp_name_list)
-        gt_fl = list(gt_fl)
-        gt_fl[-3:] = 'h5'
-        gt_fl = "".join(gt_fl)
-
-        h5f = h5py.File(gt_fl, 'r')
-        lbl = h5f['gt'][:]
-        lbl = binarize_targets(lbl)
+        img, lbl, ID = read_example(fl)
+        images.append(img)
         labels.append(lbl)
-        h5f.close()
-
-        flbase = os.path.basename(fl)
-        ids.append(flbase)
+        ids.append(ID)
 
     images = np.array(images, dtype=np.float32)
-    images = images.transpose((0, 2, 3, 1))
     labels = np.array(labels, dtype=np.int32)
     ids = np.array(ids)
 
@@ -140,10 +164,13 @@ def creat_tf_records():
     print('Data Loaded.')
     print(' Data : ', images_data.shape, '\n')
 
-    train_images, test_images, train_labels, test_labels, \
-        train_ids, test_ids = train_test_split(images_data, labels_data, ids_data,
-                                               test_size=config.TEST_SPLIT,
-                                               random_state=42)
+    manifest = split_manifest.load_or_create_manifest(ids_data)
+    train_mask, test_mask = split_manifest.split_masks(ids_data, manifest,
+                                                       config.TEST_FOLD, config.TRAIN_FOLDS)
+    train_images, train_labels, train_ids = \
+        images_data[train_mask], labels_data[train_mask], ids_data[train_mask]
+    test_images, test_labels, test_ids = \
+        images_data[test_mask], labels_data[test_mask], ids_data[test_mask]
 
     print('Train data : ')
     print(train_images.shape)
@@ -172,5 +199,38 @@ def creat_tf_records():
                  tfrecord_name=TFRECORD_ROOT + 'test.tfrecords', lbl='test')
 
 
+def creat_tf_records_streaming():
+    '''
+    same output as creat_tf_records, but train / test membership is assigned
+    on the file list before any pixel is read and records are written while
+    the examples are read, so memory does not grow with the dataset
+    '''
+    files = glob.glob(config.TF_IMG_SRC)
+    files.sort()
+    print('Examples : ', len(files), '\n')
+
+    files = np.array(files)
+    manifest = split_manifest.load_or_create_manifest(files)
+    train_mask, test_mask = split_manifest.split_masks(files, manifest,
+                                                       config.TEST_FOLD, config.TRAIN_FOLDS)
+    train_files = shuffle(files[train_mask], random_state=config.SPLIT_SEED)
+    test_files = shuffle(files[test_mask], random_state=config.SPLIT_SEED)
+
+    TFRECORD_ROOT = './record/'
+    if not os.path.exists(TFRECORD_ROOT):
+        os.makedirs(TFRECORD_ROOT)
+
+    # Write Train TFRecords
+    write_record_stream((read_example(fl) for fl in train_files), len(train_files),
+                        tfrecord_name=TFRECORD_ROOT + 'train.tfrecords', lbl='train')
+    print('\n')
+    # Write Test TFRecords
+    write_record_stream((read_example(fl) for fl in test_files), len(test_files),
+                        tfrecord_name=TFRECORD_ROOT + 'test.tfrecords', lbl='test')
+
+
 if __name__ == '__main__':
-    creat_tf_records()
+    if config.STREAM_TFRECORDS:
+        creat_tf_records_streaming()
+    else:
+        creat_tf_records()
@@ -4,15 +4,108 @@
 from __future__ import division, print_function, absolute_import
 import tensorflow as tf
 import os
+import json
 import config
 import numpy as np
 
+FLAGS = tf.app.flags.FLAGS
 
-def inputs(record_file, batch_size=32, do_test=False):
 
-    feature = {'train/image': tf.FixedLenFeature([], tf.string),
-               'train/label': tf.FixedLenFeature([], tf.string),
-               'train/id': tf.FixedLenFeature([], tf.string)}
+# format of records written before index.json carried one
+LEGACY_FORMAT = {'compression': None, 'image_dtype': 'float32', 'label_dtype': 'int32'}
+
+_IMAGE_DTYPES = {'float32': tf.float32, 'float16': tf.float16, 'uint16': tf.uint16}
+_LABEL_DTYPES = {'int32': tf.int32, 'uint8': tf.uint8}
+
+# BraTS gt label -> class index, inverse of config.CLASS_LABELS
+_LABEL_TO_CLASS = np.zeros(max(config.CLASS_LABELS) + 1, dtype=np.int32)
+_LABEL_TO_CLASS[config.CLASS_LABELS] = np.arange(len(config.CLASS_LABELS))
+
+
+def _load_index(tfrecord_root):
+    index_path = os.path.join(tfrecord_root, 'index.json')
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def record_files(lbl, tfrecord_root=config.TFRECORD_ROOT):
+    """
+    lbl: 'train' or 'test'. returns the shards of that split listed in the
+    index.json written by step2, or the single '{lbl}.tfrecords' without one
+    """
+    index = _load_index(tfrecord_root)
+    if index is None:
+        return [os.path.join(tfrecord_root, '{}.tfrecords'.format(lbl))]
+    return [os.path.join(tfrecord_root, str(name)) for name in index[lbl]['files']]
+
+
+def record_format(tfrecord_root=config.TFRECORD_ROOT):
+    """
+    compression / image_dtype / label_dtype the records were written with
+    """
+    index = _load_index(tfrecord_root) or {}
+    return dict((k, index.get(k, v)) for k, v in LEGACY_FORMAT.items())
+
+
+def reader_options(fmt):
+    if fmt['compression'] is None:
+        return None
+    return tf.python_io.TFRecordOptions(
+        getattr(tf.python_io.TFRecordCompressionType, str(fmt['compression'])))
+
+
+_FEATURES = {'train/image': tf.FixedLenFeature([], tf.string),
+             'train/label': tf.FixedLenFeature([], tf.string),
+             'train/id': tf.FixedLenFeature([], tf.string)}
+
+
+def _decode(features, fmt, batch_shape):
+
+    image = tf.decode_raw(features['train/image'], _IMAGE_DTYPES[fmt['image_dtype']])
+    image = tf.cast(image, tf.float32)
+    if fmt['image_dtype'] == 'uint16':
+        image = image / 65535.0
+    label = tf.decode_raw(features['train/label'], _LABEL_DTYPES[fmt['label_dtype']])
+    label = tf.gather(_LABEL_TO_CLASS, tf.cast(label, tf.int32))
+    ID = features['train/id']
+
+    image = tf.reshape(image, batch_shape + [config.ORIG_SIZE, config.ORIG_SIZE, 4])
+    label = tf.reshape(label, batch_shape + [config.ORIG_SIZE, config.ORIG_SIZE])
+    return [image, label, ID]
+
+
+def decode_example(serialized_example, fmt):
+    """
+    returns [image (ORIG_SIZE, ORIG_SIZE, 4) float32, label (ORIG_SIZE, ORIG_SIZE) int32 class index, ID]
+    whatever dtypes the record was written with
+    """
+    features = tf.parse_single_example(serialized_example, features=_FEATURES)
+    return _decode(features, fmt, [])
+
+
+def decode_batch(serialized_batch, fmt):
+    """
+    decode_example for a [batch] vector of records, parsed with one parse_example
+    """
+    features = tf.parse_example(serialized_batch, features=_FEATURES)
+    return _decode(features, fmt, [-1])
+
+
+def _read_example(filename_queue, fmt):
+
+    reader = tf.TFRecordReader(options=reader_options(fmt))
+    _, serialized_example = reader.read(filename_queue)
+    return decode_example(serialized_example, fmt)
+
+
+def inputs(record_file, batch_size=32, do_test=False, fmt=None):
+    """
+    fmt: record format (see record_format), read from index.json when None
+    """
+    if fmt is None:
+        fmt = record_format()
 
     # filename_queue = tf.train.string_input_producer(record_file,
     #                                                 num_epochs=config.N_EPOCHS
@@ -20,17 +113,9 @@ def inputs(record_file, batch_size=32, do_test=False):
     filename_queue = tf.train.string_input_producer(record_file,
                                                     num_epochs=config.N_EPOCHS)
 
-    reader = tf.TFRecordReader()
-    _, serialized_example = reader.read(filename_queue)
-    features = tf.parse_single_example(serialized_example, features=feature)
-
-    image = tf.decode_raw(features['train/image'], tf.float32)
-    # label = tf.decode_raw(features['train/label'], tf.float32)
-    label = tf.decode_raw(features['train/label'], tf.int32)
-    ID = features['train/id']
-
-    image = tf.reshape(image, [config.ORIG_SIZE, config.ORIG_SIZE, 4])
-    label = tf.reshape(label, [config.ORIG_SIZE, config.ORIG_SIZE])
+    # one reader per shard (up to NUM_READERS), so shards are read interleaved
+    num_readers = max(1, min(len(record_file), config.NUM_READERS))
+    examples = [_read_example(filename_queue, fmt) for _ in range(num_readers)]
 
     min_fraction_of_examples_in_queue = 0.4
     num_examples_per_epoch = config.NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN if not do_test else config.NUM_EXAMPLES_PER_EPOCH_FOR_TEST
@@ -38,21 +123,93 @@ def inputs(record_file, batch_size=32, do_test=False):
                              min_fraction_of_examples_in_queue)
 
     num_preprocess_threads = 16
-    images, labels, ID_batch = tf.train.shuffle_batch(
-        [image, label, ID],
-        batch_size=batch_size,
-        num_threads=num_preprocess_threads,
-        capacity=min_queue_examples + 3 * batch_size,
-        min_after_dequeue=min_queue_examples,
-        allow_smaller_final_batch=True)
+    if num_readers == 1:
+        images, labels, ID_batch = tf.train.shuffle_batch(
+            examples[0],
+            batch_size=batch_size,
+            num_threads=num_preprocess_threads,
+            capacity=min_queue_examples + 3 * batch_size,
+            min_after_dequeue=min_queue_examples,
+            allow_smaller_final_batch=True)
+    else:
+        images, labels, ID_batch = tf.train.shuffle_batch_join(
+            examples,
+            batch_size=batch_size,
+            capacity=min_queue_examples + 3 * batch_size,
+            min_after_dequeue=min_queue_examples,
+            allow_smaller_final_batch=True)
 
     return images, labels, ID_batch
 
 
+def dataset_inputs(record_file, batch_size=32, do_test=False, fmt=None):
+    """
+    tf.data version of inputs with the same (images, labels, ids) contract:
+    shards are interleaved, shuffled in a buffer, parsed a whole batch at a
+    time by parallel map calls and prefetched. needs no queue runners
+    """
+    if fmt is None:
+        fmt = record_format()
+    compression_type = '' if fmt['compression'] is None else str(fmt['compression'])
+
+    num_examples_per_epoch = config.NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN if not do_test else config.NUM_EXAMPLES_PER_EPOCH_FOR_TEST
+    shuffle_buffer = max(batch_size, int(num_examples_per_epoch * 0.4))
+
+    files = tf.data.Dataset.from_tensor_slices(record_file)
+    files = files.shuffle(len(record_file)).repeat(config.N_EPOCHS)
+
+    dataset = files.interleave(
+        lambda f: tf.data.TFRecordDataset(f, compression_type=compression_type),
+        cycle_length=max(1, min(len(record_file), config.NUM_READERS)),
+        block_length=1)
+    dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda serialized: tuple(decode_batch(serialized, fmt)),
+                          num_parallel_calls=config.NUM_PARSE_CALLS)
+    dataset = dataset.prefetch(config.PREFETCH_BATCHES)
+
+    images, labels, ID_batch = dataset.make_one_shot_iterator().get_next()
+    return images, labels, ID_batch
+
+
+def eval_inputs(record_file, batch_size=32, fmt=None):
+    """
+    one ordered pass over record_file : (images, labels, ids) batches until
+    tf.errors.OutOfRangeError, the last batch may be smaller
+    """
+    if fmt is None:
+        fmt = record_format()
+    compression_type = '' if fmt['compression'] is None else str(fmt['compression'])
+
+    dataset = tf.data.TFRecordDataset(record_file, compression_type=compression_type)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda serialized: tuple(decode_batch(serialized, fmt)),
+                          num_parallel_calls=config.NUM_PARSE_CALLS)
+    dataset = dataset.prefetch(config.PREFETCH_BATCHES)
+
+    images, labels, ID_batch = dataset.make_one_shot_iterator().get_next()
+    return images, labels, ID_batch
+
+
+def crop_batch(images, labels, image_size, sparse_labels=False):
+    """
+    center crops a batch to image_size. labels (class maps) come back as uint8
+    [batch, size, size] with sparse_labels, one-hot [batch, size, size, num_class] otherwise
+    """
+    images = tf.image.resize_image_with_crop_or_pad(images, image_size, image_size)
+    if sparse_labels:
+        labels = tf.expand_dims(tf.cast(labels, tf.uint8), -1)
+        labels = tf.image.resize_image_with_crop_or_pad(labels, image_size, image_size)
+        return images, tf.squeeze(labels, axis=3)
+    labels = tf.one_hot(labels, FLAGS.num_class)
+    labels = tf.image.resize_image_with_crop_or_pad(labels, image_size, image_size)
+    return images, labels
+
+
 if __name__ == '__main__':
 
     TEST_BATCH_SIZE = 10
-    images, labels, ids = inputs(['./record/test.tfrecords'],
+    images, labels, ids = inputs(record_files('test'),
                                  TEST_BATCH_SIZE, True)
 
     labels_onehot = tf.one_hot(labels, 2)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+FLOPs / parameters / CPU latency of the dense 7x7 models against their
+separable and factorized variants, inference graph (frozen batch norm).
+
+    python bench_models.py --batch_size=8
+"""
+
+from __future__ import division, print_function, absolute_import
+import time
+import numpy as np
+import tensorflow as tf
+
+import config
+from main_placeholder_multiclass import build_model
+
+FLAGS = tf.app.flags.FLAGS
+
+MODELS = ['basic', 'basic_separable', 'basic_factorized',
+          'extended', 'extended_separable', 'extended_factorized']
+N_WARMUP = 3
+N_STEPS = 20
+
+
+def bench_model(model, batch_size):
+    with tf.Graph().as_default() as graph:
+        images = tf.placeholder(tf.float32,
+                                shape=[batch_size, FLAGS.image_h, FLAGS.image_w, FLAGS.image_c])
+        logits = build_model(images, False, 1.0, model=model)
+        class_pred = tf.argmax(logits, axis=3)
+
+        flops = tf.profiler.profile(graph, options=tf.profiler.ProfileOptionBuilder.float_operation())
+        n_params = sum(np.prod(v.get_shape().as_list()) for v in tf.trainable_variables())
+
+        images_batch = np.random.rand(batch_size, FLAGS.image_h, FLAGS.image_w,
+                                      FLAGS.image_c).astype(np.float32)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(N_WARMUP):
+                sess.run(class_pred, feed_dict={images: images_batch})
+            start_time = time.time()
+            for _ in range(N_STEPS):
+                sess.run(class_pred, feed_dict={images: images_batch})
+            sec_per_batch = (time.time() - start_time) / N_STEPS
+
+    return flops.total_float_ops, n_params, sec_per_batch
+
+
+def main(args):
+    results = [(model,) + bench_model(model, FLAGS.batch_size) for model in MODELS]
+
+    print('\n =====================================================')
+    print('  inference, batch size {}, {}x{}x{}'.format(FLAGS.batch_size, FLAGS.image_h,
+                                                        FLAGS.image_w, FLAGS.image_c))
+    print('  {:<20} | {:>10} | {:>12} | {:>10} | {:>10}'.format(
+        'model', 'params', 'GFLOPs/slice', 'ms/batch', 'slices/sec'))
+    for model, flops, n_params, sec_per_batch in results:
+        print('  {:<20} | {:>10d} | {:>12.2f} | {:>10.1f} | {:>10.1f}'.format(
+            model, int(n_params), flops / FLAGS.batch_size / 1e9,
+            1000 * sec_per_batch, FLAGS.batch_size / sec_per_batch))
+    print(' =====================================================')
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Per patient memory / time comparison of the old float64 copy-loop loader and
+the compact BrainPipeline.read_scans.
+
+    python bench_read_scans.py [patient_dir ...]
+"""
+
+from __future__ import division, print_function, absolute_import
+import sys
+import time
+import numpy as np
+from glob import glob
+from skimage import io
+
+import config
+from step1_write_all_pickles import BrainPipeline
+
+
+def read_scans_legacy(path):
+    # the loader as it was : two float64 volumes and a per-slice copy loop
+    slices_by_mode = np.zeros((5, 155, 240, 240))
+    slices_by_slice = np.zeros((155, 5, 240, 240))
+
+    scans = [glob(path + '*_flair.nii.gz')[0],
+             glob(path + '/*_t1.nii.gz')[0],
+             glob(path + '/*_t1ce.nii.gz')[0],
+             glob(path + '/*_t2.nii.gz')[0],
+             glob(path + '/*_seg.nii.gz')[0]]
+
+    for scan_idx in range(5):
+        slices_by_mode[scan_idx] = io.imread(scans[scan_idx], plugin='simpleitk').astype(float)
+    for mode_ix in range(slices_by_mode.shape[0]):
+        for slice_ix in range(slices_by_mode.shape[1]):
+            slices_by_slice[slice_ix][mode_ix] = slices_by_mode[mode_ix][slice_ix]
+    return slices_by_mode, slices_by_slice
+
+
+def read_scans_compact(path):
+    pipe = BrainPipeline.__new__(BrainPipeline)
+    pipe.path = path
+    return pipe.read_scans()
+
+
+def bench_patient(path):
+    start_time = time.time()
+    by_mode, by_slice = read_scans_legacy(path)
+    legacy_sec = time.time() - start_time
+    legacy_mb = (by_mode.nbytes + by_slice.nbytes) / 2.0**20
+    del by_mode, by_slice
+
+    start_time = time.time()
+    by_mode, by_slice, gt = read_scans_compact(path)
+    compact_sec = time.time() - start_time
+    compact_mb = by_mode.nbytes / 2.0**20 + gt.nbytes / 2.0**20
+    if not np.may_share_memory(by_mode, by_slice):
+        compact_mb += by_slice.nbytes / 2.0**20
+
+    print('{}'.format(path))
+    print('    legacy  : {:8.1f} MB  {:6.2f} sec'.format(legacy_mb, legacy_sec))
+    print('    compact : {:8.1f} MB  {:6.2f} sec'.format(compact_mb, compact_sec))
+    sys.stdout.flush()
+    return legacy_mb, legacy_sec, compact_mb, compact_sec
+
+
+if __name__ == '__main__':
+
+    patients = sys.argv[1:] or glob(config.SRC_NIFTY_DIR)[:2]
+    results = np.array([bench_patient(p) for p in patients])
+
+    legacy_mb, legacy_sec, compact_mb, compact_sec = results.mean(0)
+    print('++++++++++++++++++++++++++++++++')
+    print('mean over {} patients'.format(len(patients)))
+    print('    memory : {:.1f} MB -> {:.1f} MB ({:.1f}x)'.format(legacy_mb, compact_mb,
+                                                             legacy_mb / compact_mb))
+    print('    time   : {:.2f} sec -> {:.2f} sec ({:.1f}x)'.format(legacy_sec, compact_sec,
+                                                               legacy_sec / compact_sec))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Training throughput with the feed_dict round-trip (batches fetched to numpy
+and fed back through placeholders) against the input pipeline wired into the
+model. Step time includes getting the batch in both cases.
+
+    python bench_train_step.py --model=basic --batch_size=64
+"""
+
+from __future__ import division, print_function, absolute_import
+import time
+import tensorflow as tf
+
+import config
+import batch_inputs
+import evaluation
+import training
+from main_placeholder_multiclass import build_model, IMAGE_SIZE
+
+FLAGS = tf.app.flags.FLAGS
+
+N_WARMUP = 5
+N_STEPS = 50
+
+
+def examples_per_sec(feed_inputs):
+    with tf.Graph().as_default():
+        x_train, y_train, _ = batch_inputs.inputs(batch_inputs.record_files('train'),
+                                                  FLAGS.batch_size, False)
+        x_train, y_train = batch_inputs.crop_batch(x_train, y_train, IMAGE_SIZE,
+                                                   FLAGS.sparse_labels)
+
+        is_training = tf.placeholder(tf.bool, name='is_training')
+        keep_prob = tf.placeholder(tf.float32, name="keep_probabilty")
+        if feed_inputs:
+            images = tf.placeholder(tf.float32, x_train.get_shape())
+            labels = tf.placeholder(y_train.dtype, y_train.get_shape())
+        else:
+            images, labels = x_train, y_train
+
+        logits = build_model(images, is_training, keep_prob)
+        if FLAGS.sparse_labels:
+            loss = evaluation.sparse_loss_calc(logits=logits, labels=labels)
+        else:
+            loss = evaluation.loss_calc(logits=logits, labels=labels)
+        train_op, _ = training.training(loss=loss)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(tf.local_variables_initializer())
+            coord = tf.train.Coordinator()
+            threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+
+            for step in range(N_WARMUP + N_STEPS):
+                if step == N_WARMUP:
+                    start_time = time.time()
+                feed_dict = {is_training: True, keep_prob: 0.5}
+                if feed_inputs:
+                    images_batch, labels_batch = sess.run([x_train, y_train])
+                    feed_dict[images] = images_batch
+                    feed_dict[labels] = labels_batch
+                sess.run(train_op, feed_dict=feed_dict)
+            duration = time.time() - start_time
+
+            coord.request_stop()
+            coord.join(threads)
+
+    return N_STEPS * FLAGS.batch_size / duration
+
+
+def main(args):
+    fed = examples_per_sec(feed_inputs=True)
+    wired = examples_per_sec(feed_inputs=False)
+    print('\n =====================================================')
+    print('  model: {}, batch size: {}, sparse labels: {}'.format(FLAGS.model, FLAGS.batch_size,
+                                                                  FLAGS.sparse_labels))
+    print('    feed_dict : {:.1f} examples/sec'.format(fed))
+    print('    wired     : {:.1f} examples/sec ({:.2f}x)'.format(wired, wired / fed))
+    print(' =====================================================')
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Time and memory of the scatter_nd unpooling (unpool_with_argmax) against the
+max pool gradient one (unpool_with_argmax_fused), for every pooling level of
+the extended model, forward + backward. Memory is what the ops of the unpool
+layer (and its gradient) allocate in one step, from a full trace.
+
+    python bench_unpool.py --batch_size=64
+"""
+
+from __future__ import division, print_function, absolute_import
+import time
+import numpy as np
+import tensorflow as tf
+
+import config
+import inference_gray
+
+FLAGS = tf.app.flags.FLAGS
+
+N_CHANNELS = 64
+N_LEVELS = 5
+N_WARMUP = 3
+N_STEPS = 20
+
+
+def unpool_allocated_bytes(run_metadata, scope):
+    total = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            if scope not in node_stats.node_name:
+                continue
+            total += sum(mem.total_bytes for mem in node_stats.memory)
+    return total
+
+
+def bench_level(size, fused):
+    with tf.Graph().as_default():
+        x = tf.Variable(tf.random_normal([FLAGS.batch_size, size, size, N_CHANNELS]))
+        pool, ind = tf.nn.max_pool_with_argmax(x, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1],
+                                               padding='SAME')
+        if fused:
+            up = inference_gray.unpool_with_argmax_fused(pool, ind, like=x, name='unpool')
+        else:
+            up = inference_gray.unpool_with_argmax(pool, ind, name='unpool')
+        grad = tf.gradients(tf.reduce_sum(up), pool)[0]
+        step = tf.group(up, grad)
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            # pooling is not what is measured, keep its outputs fixed
+            pool_val, ind_val = sess.run([pool, ind])
+            feed_dict = {pool: pool_val, ind: ind_val}
+
+            for _ in range(N_WARMUP):
+                sess.run(step, feed_dict=feed_dict)
+            start_time = time.time()
+            for _ in range(N_STEPS):
+                sess.run(step, feed_dict=feed_dict)
+            sec_per_step = (time.time() - start_time) / N_STEPS
+
+            run_metadata = tf.RunMetadata()
+            sess.run(step, feed_dict=feed_dict,
+                     options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                     run_metadata=run_metadata)
+
+    return sec_per_step, unpool_allocated_bytes(run_metadata, 'unpool')
+
+
+def main(args):
+    print('\n =====================================================')
+    print('  unpool fwd + bwd, batch size {}, {} channels'.format(FLAGS.batch_size, N_CHANNELS))
+    print('  {:>12} | {:>20} | {:>20}'.format('level (in)', 'scatter ms / MB', 'fused ms / MB'))
+    size = FLAGS.image_h
+    for level in range(1, N_LEVELS + 1):
+        scatter_sec, scatter_bytes = bench_level(size, fused=False)
+        fused_sec, fused_bytes = bench_level(size, fused=True)
+        print('  {:>4} ({:>3}) | {:>9.2f} / {:>8.1f} | {:>9.2f} / {:>8.1f}'.format(
+            level, size,
+            1000 * scatter_sec, scatter_bytes / 2.0**20,
+            1000 * fused_sec, fused_bytes / 2.0**20))
+        size = int(np.ceil(size / 2))
+    print(' =====================================================')
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Per patient 3D BraTS metrics : Dice, sensitivity and 95th percentile
+Hausdorff distance of the whole tumour, tumour core and enhancing tumour
+regions, computed by a process pool.
+
+    python brats_metrics.py --model=basic [model.ckpt-N]
+
+config.METRICS_SOURCE picks the volumes scored
+    'volumes' : every slice of the test fold patients is segmented from the
+                NIfTI (infer_volume.VolumeSegmenter) and scored against their
+                *_seg.nii.gz, comparable with BraTS numbers
+    'records' : the test records, put back into patient volumes from their
+                HGG_patient_{n}_{slice}_.h5 ids. The records only hold the
+                step1 tumour slices, cropped to IMAGE_SIZE : false positives on
+                healthy slices and outside the crop are never counted, so
+                these tumour slice subset metrics are optimistic
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import json
+import time
+import collections
+import multiprocessing
+from glob import glob
+import numpy as np
+from scipy import ndimage
+import tensorflow as tf
+import SimpleITK as sitk
+
+import config
+import split_manifest
+import infer_volume
+from evaluate import predict_checkpoint
+
+FLAGS = tf.app.flags.FLAGS
+
+N_SLICES = 155
+# BraTS labels of every region
+REGIONS = collections.OrderedDict([('WT', (1, 2, 4)),
+                                   ('TC', (1, 4)),
+                                   ('ET', (4,))])
+METRICS = ['dice', 'sensitivity', 'hd95']
+SOURCES = {'volumes': 'whole volumes of the test patients',
+           'records': 'TUMOUR SLICE SUBSET of the test records, optimistic, '
+                      'not comparable with BraTS numbers'}
+
+
+def _as_str(ID):
+    return ID if isinstance(ID, str) else ID.decode('utf-8')
+
+
+def slice_of(slice_id):
+    # HGG_patient_{n}_{slice}_.h5 -> slice
+    return int(os.path.basename(slice_id).split('_')[3])
+
+
+def patient_volumes(class_maps, labels, ids):
+    """
+    class_maps, labels: [n, h, w] class indices of n slices, ids their slice ids.
+    returns {patient: (prediction, gt)}, (155, h, w) uint8 BraTS label volumes
+    with every slice at its axial index, slices without an id left 0
+    """
+    to_label = np.asarray(config.CLASS_LABELS, dtype=np.uint8)
+    members = collections.defaultdict(list)
+    for n, ID in enumerate(ids):
+        ID = _as_str(ID)
+        members[split_manifest.patient_of(ID)].append((slice_of(ID), n))
+
+    volumes = {}
+    for patient, slices in members.items():
+        z, n = [np.array(v) for v in zip(*slices)]
+        prediction = np.zeros((N_SLICES,) + class_maps.shape[1:], dtype=np.uint8)
+        gt = np.zeros_like(prediction)
+        prediction[z] = to_label[class_maps[n]]
+        gt[z] = to_label[labels[n]]
+        volumes[patient] = (prediction, gt)
+    return volumes
+
+
+def test_patient_dirs(manifest_path=config.SPLIT_MANIFEST, test_fold=config.TEST_FOLD):
+    """
+    returns {patient: NIfTI dir} of the test fold patients, found in
+    config.SRC_NIFTY_DIR by the dir names the split manifest keeps
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if 'names' not in manifest:
+        raise ValueError("Split manifest {} has no patient names, re-run step1 and step2 "
+                         "to find the test patients in {}".format(manifest_path, config.SRC_NIFTY_DIR))
+    names = dict((p, manifest['names'][p]) for p, fold in manifest['folds'].items()
+                 if fold == test_fold)
+    dirs = dict((split_manifest.patient_name(path), path) for path in glob(config.SRC_NIFTY_DIR))
+    missing = set(names.values()) - set(dirs)
+    if missing:
+        raise ValueError("Test patients {} are not in {}".format(sorted(missing), config.SRC_NIFTY_DIR))
+    return dict((p, dirs[name]) for p, name in names.items())
+
+
+def read_seg(path):
+    seg = glob(os.path.join(path, '*_seg.nii.gz'))[0]
+    return sitk.GetArrayFromImage(sitk.ReadImage(seg)).astype(np.uint8)
+
+
+def segmented_volumes(ckpt, patient_dirs):
+    """
+    yields (patient, prediction, gt) (155, 240, 240) BraTS label volumes, one
+    patient segmented at a time
+    """
+    segmenter = infer_volume.VolumeSegmenter(ckpt=ckpt, frozen_graph=FLAGS.frozen_graph)
+    try:
+        for patient, path in sorted(patient_dirs.items()):
+            volume, _ = infer_volume.read_volume(path)
+            yield patient, segmenter.segment_volume(volume), read_seg(path)
+    finally:
+        segmenter.close()
+
+
+def hd95(prediction, gt, spacing=(1.0, 1.0, 1.0)):
+    """
+    95th percentile of the symmetric surface distances of two boolean masks,
+    nan when either is empty. distance transforms run on the bounding box of
+    both masks only
+    """
+    if not prediction.any() or not gt.any():
+        return np.nan
+    coords = np.nonzero(prediction | gt)
+    box = tuple(slice(max(c.min() - 1, 0), c.max() + 2) for c in coords)
+    prediction, gt = prediction[box], gt[box]
+
+    prediction_surface = prediction ^ ndimage.binary_erosion(prediction)
+    gt_surface = gt ^ ndimage.binary_erosion(gt)
+    to_gt = ndimage.distance_transform_edt(~gt_surface, sampling=spacing)
+    to_prediction = ndimage.distance_transform_edt(~prediction_surface, sampling=spacing)
+    distances = np.concatenate([to_gt[prediction_surface], to_prediction[gt_surface]])
+    return np.percentile(distances, 95)
+
+
+def region_metrics(prediction, gt):
+    """
+    prediction, gt: boolean masks of one region
+    dice is 1 when both are empty, sensitivity nan when gt is empty
+    """
+    overlap = np.count_nonzero(prediction & gt)
+    n_prediction = np.count_nonzero(prediction)
+    n_gt = np.count_nonzero(gt)
+    return {'dice': 2 * overlap / (n_prediction + n_gt) if n_prediction + n_gt else 1.0,
+            'sensitivity': overlap / n_gt if n_gt else np.nan,
+            'hd95': hd95(prediction, gt)}
+
+
+def _patient_metrics(job):
+    patient, prediction, gt = job
+    return patient, dict((region, region_metrics(np.isin(prediction, labels), np.isin(gt, labels)))
+                         for region, labels in REGIONS.items())
+
+
+def evaluate_patients(jobs, n_workers=config.METRICS_WORKERS):
+    """
+    jobs: iterable of (patient, prediction, gt) BraTS label volumes. every job
+    is handed to the pool as soon as it is produced, so a generator (see
+    segmented_volumes) overlaps with the metrics of the patients before it.
+    At most 2 * n_workers jobs are held at a time, the next one is only taken
+    from jobs once the oldest is scored
+    returns {patient: {region: {metric: value}}}, patients spread over n_workers
+    processes (1 -> serial, None -> one per core)
+    """
+    if n_workers == 1:
+        return dict(map(_patient_metrics, jobs))
+    n_workers = n_workers or multiprocessing.cpu_count()
+    results = {}
+    in_flight = collections.deque()
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        for job in jobs:
+            if len(in_flight) >= 2 * n_workers:
+                patient, metrics = in_flight.popleft().get()
+                results[patient] = metrics
+            in_flight.append(pool.apply_async(_patient_metrics, (job,)))
+        while in_flight:
+            patient, metrics = in_flight.popleft().get()
+            results[patient] = metrics
+        return results
+    finally:
+        pool.close()
+        pool.join()
+
+
+def summarize(results):
+    """
+    mean / median of every region metric over the patients, ignoring nan
+    """
+    summary = collections.OrderedDict()
+    for region in REGIONS:
+        for metric in METRICS:
+            values = np.array([r[region][metric] for r in results.values()], dtype=np.float64)
+            summary['{}_{}'.format(region, metric)] = {'mean': np.nanmean(values),
+                                                       'median': np.nanmedian(values),
+                                                       'n': int(np.count_nonzero(~np.isnan(values)))}
+    return summary
+
+
+def main(argv):
+    ckpt = argv[1] if len(argv) > 1 else tf.train.latest_checkpoint(FLAGS.log_dir)
+    # the records are only predicted from a checkpoint
+    if ckpt is None and not (FLAGS.frozen_graph and config.METRICS_SOURCE == 'volumes'):
+        sys.exit("No checkpoint in {}, pass one or set --log_dir".format(FLAGS.log_dir))
+
+    start_time = time.time()
+    if config.METRICS_SOURCE == 'volumes':
+        results = evaluate_patients(segmented_volumes(ckpt, test_patient_dirs()))
+    elif config.METRICS_SOURCE == 'records':
+        class_maps, labels, ids = [np.concatenate(v) for v in zip(*predict_checkpoint(ckpt))]
+        volumes = patient_volumes(class_maps, labels, ids)
+        del class_maps, labels, ids
+        results = evaluate_patients((patient, prediction, gt) for patient, (prediction, gt)
+                                    in sorted(volumes.items()))
+    else:
+        raise ValueError("Unknown METRICS_SOURCE {}".format(config.METRICS_SOURCE))
+    duration = time.time() - start_time
+    summary = summarize(results)
+
+    print('\n =====================================================')
+    print('  {} : {} patients in {:.1f} sec'.format(ckpt, len(results), duration))
+    print('  {}'.format(SOURCES[config.METRICS_SOURCE]))
+    print('  {:<16} | {:>8} | {:>8} | {:>4}'.format('', 'mean', 'median', 'n'))
+    for name, values in summary.items():
+        print('  {:<16} | {:>8.3f} | {:>8.3f} | {:>4d}'.format(name, values['mean'],
+                                                              values['median'], values['n']))
+    print(' =====================================================')
+
+    with open(config.BRATS_METRICS_JSON, 'w') as f:
+        # nan is written as NaN, which json.load reads back
+        json.dump({'checkpoint': ckpt, 'source': SOURCES[config.METRICS_SOURCE],
+                   'summary': summary, 'patients': results}, f, indent=2)
+    print('Metrics written to ', config.BRATS_METRICS_JSON)
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint saving for train : the variables are fetched from the training
+session in the step loop, written by a background thread, and checkpoints no
+retention policy keeps are removed.
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import json
+import time
+import threading
+import tensorflow as tf
+
+import config
+
+
+class CheckpointManager(object):
+    '''
+    Saves the global variables of the training graph as directory/model.ckpt-<step>.
+    save only fetches the variable values, a copy of them in a CPU graph of
+    its own is written to disk on a background thread while training goes on.
+    After every save the checkpoints are pruned to
+        the last keep_last,
+        one every keep_every_hours hours (None : none),
+        the keep_best with the highest validation metric, taken from save(metrics=)
+        or from the evaluator.py results in directory/eval,
+        the newest max_pending without a metric yet, left for evaluator.py
+    and the 'checkpoint' state file lists the kept ones. The checkpoints in
+    that file when the manager starts (an earlier or finetuned run) are
+    pruned with them, metrics given to save are kept in directory/CKPT_METRICS_JSON.
+    '''
+
+    def __init__(self, directory, var_list=None, keep_last=config.CKPT_KEEP_LAST,
+                 keep_every_hours=config.CKPT_KEEP_HOURS, keep_best=config.CKPT_KEEP_BEST,
+                 metric=config.CKPT_BEST_METRIC, max_pending=config.CKPT_MAX_PENDING):
+        self.directory = directory
+        self.prefix = os.path.join(directory, 'model.ckpt')
+        self.keep_last = keep_last
+        self.keep_every_secs = keep_every_hours * 3600 if keep_every_hours else None
+        self.keep_best = keep_best
+        self.metric = metric
+        self.max_pending = max_pending
+        self.eval_json = os.path.join(directory, config.EVAL_SUBDIR, config.EVAL_JSON)
+        self.metrics_json = os.path.join(directory, config.CKPT_METRICS_JSON)
+
+        self.variables = var_list or tf.global_variables()
+        self.graph = tf.Graph()
+        with self.graph.as_default(), tf.device('/cpu:0'):
+            self.placeholders = [tf.placeholder(v.dtype.base_dtype, v.get_shape())
+                                 for v in self.variables]
+            # same names as the training variables, the checkpoints restore into the training graph
+            copies = [tf.Variable(p, name=v.op.name, trainable=False, collections=[])
+                      for v, p in zip(self.variables, self.placeholders)]
+            self.assign = [c.initializer for c in copies]
+            self.saver = tf.train.Saver(dict((v.op.name, c) for v, c in zip(self.variables, copies)),
+                                        max_to_keep=None)
+        self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        # kept checkpoint paths in save order, their metric (None until known)
+        self.checkpoints = []
+        self.metrics = {}
+        self.preserved = set()
+        self.next_preserve = time.time() + self.keep_every_secs if self.keep_every_secs else None
+        self._load_state()
+        self.thread = None
+        self.error = None
+
+    def _load_state(self):
+        state = tf.train.get_checkpoint_state(self.directory)
+        if state is None:
+            return
+        saved = {}
+        if os.path.exists(self.metrics_json):
+            with open(self.metrics_json) as f:
+                saved = json.load(f)
+        next_preserve = None
+        for path in state.all_model_checkpoint_paths:
+            if not tf.train.checkpoint_exists(path):
+                continue
+            self.checkpoints.append(path)
+            self.metrics[path] = saved.get(os.path.basename(path))
+            # the hourly checkpoints of the earlier run, from the file times
+            if self.keep_every_secs:
+                mtime = os.path.getmtime(path + '.index')
+                if next_preserve is None:
+                    next_preserve = mtime + self.keep_every_secs
+                elif mtime >= next_preserve:
+                    self.preserved.add(path)
+                    next_preserve = mtime + self.keep_every_secs
+        if next_preserve is not None:
+            self.next_preserve = next_preserve
+        if self.checkpoints:
+            print('{} checkpoints of an earlier run in {}'.format(len(self.checkpoints), self.directory))
+
+    def save(self, sess, step, metrics=None):
+        '''
+        metrics: validation metrics of the checkpoint (evaluation.hist_metrics), if known.
+        waits for the previous save to be written
+        '''
+        self.wait()
+        values = sess.run(self.variables)
+        metric = metrics[self.metric] if metrics else None
+        self.thread = threading.Thread(target=self._write, args=(values, step, metric))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.sess.close()
+
+    def best(self):
+        '''
+        returns the (path, metric) of the kept checkpoints with a known metric, best first
+        '''
+        # metric == metric : not nan
+        scored = [(path, self.metrics[path]) for path in self.checkpoints
+                  if self.metrics[path] is not None and self.metrics[path] == self.metrics[path]]
+        return sorted(scored, key=lambda item: item[1], reverse=True)
+
+    def _write(self, values, step, metric):
+        try:
+            self.sess.run(self.assign, feed_dict=dict(zip(self.placeholders, values)))
+            path = self.saver.save(self.sess, self.prefix, global_step=step,
+                                   write_meta_graph=False, write_state=False)
+            self.checkpoints.append(path)
+            self.metrics[path] = metric
+            if self.next_preserve is not None and time.time() >= self.next_preserve:
+                self.preserved.add(path)
+                self.next_preserve = time.time() + self.keep_every_secs
+            self._prune()
+            tf.train.update_checkpoint_state(self.directory, path,
+                                             all_model_checkpoint_paths=self.checkpoints)
+            self._write_metrics()
+        except Exception as e:
+            self.error = e
+
+    def _read_eval_metrics(self):
+        if not os.path.exists(self.eval_json):
+            return
+        try:
+            with open(self.eval_json) as f:
+                results = json.load(f)
+        except ValueError:
+            return
+        for path in self.checkpoints:
+            name = os.path.basename(path)
+            if self.metrics[path] is None and name in results:
+                self.metrics[path] = results[name][self.metric]
+
+    def _prune(self):
+        keep = set(self.preserved)
+        if self.keep_last:
+            keep.update(self.checkpoints[-self.keep_last:])
+        if self.keep_best:
+            self._read_eval_metrics()
+            keep.update(path for path, _ in self.best()[:self.keep_best])
+            if self.max_pending:
+                pending = [p for p in self.checkpoints if self.metrics[p] is None]
+                keep.update(pending[-self.max_pending:])
+
+        for path in [p for p in self.checkpoints if p not in keep]:
+            for f in tf.gfile.Glob(path + '.*'):
+                tf.gfile.Remove(f)
+            self.checkpoints.remove(path)
+            del self.metrics[path]
+
+    def _write_metrics(self):
+        known = dict((os.path.basename(p), self.metrics[p]) for p in self.checkpoints
+                     if self.metrics[p] is not None)
+        with open(self.metrics_json, 'w') as f:
+            json.dump(known, f, indent=2, sort_keys=True)
@@ -15,26 +15,74 @@ DST_JPG_DIR = './BRATS/HGG/'
 MODALITY_DICT = {'flair': 0, 't1': 1, 't1s': 2, 't2': 3, 'gt': 4}
 MODALITY = 't1'
 
+# BraTS label of every model class : the gt labels 0 / 1 / 2 / 4 are trained as classes 0 - 3
+CLASS_LABELS = [0, 1, 2, 4]
+
 
 IMG_MODE = 'reg'
 
+# step1 'norm' / 'n4' normalization : brain-only statistics, per slice percentile clipping
+NORM_BRAIN_MASK = False
+NORM_CLIP_PCT = None  # e.g. (0.5, 99.5)
+
+# step1 ingestion pool : 1 -> serial, None -> one worker per core
+INGEST_WORKERS = 1
+
 TASK = 'all'
 
 
 # For step2_write_tfrecord
 TF_IMG_SRC = './BRATS/HGG/t1/reg_JPG/*'
+# write records while reading, train / test split assigned on the file list
+STREAM_TFRECORDS = True
+# streaming writer : shards per split, writer processes (None -> one per core)
+TFRECORD_SHARDS = 8
+TFRECORD_WORKERS = None
+TFRECORD_ROOT = './record/'
+# record format : compression None / 'GZIP' / 'ZLIB', images 'float32' / 'float16' /
+# 'uint16' (quantized, 'reg' images only), labels 'int32' / 'uint8'
+TFRECORD_COMPRESSION = 'GZIP'
+TFRECORD_IMAGE_DTYPE = 'float16'
+TFRECORD_LABEL_DTYPE = 'uint8'
+# parallel TFRecordReaders over the shards in batch_inputs
+NUM_READERS = 4
+# tf.data input pipeline (FLAGS.use_tf_data) : parallel batch parsing, prefetched batches
+NUM_PARSE_CALLS = 4
+PREFETCH_BATCHES = 2
 # H5_SRC = './BRATS/HGG/HGG_patient_*.h5'
 H5_SRC = './BRATS/HGG/'
+# single consolidated store written by step1 save_patient_store (see h5_store)
+H5_STORE = './BRATS/HGG_store.h5'
+USE_H5_STORE = False
 
 
 """ AFFECTS HOW CODE RUNS"""
 
 tf.app.flags.DEFINE_string('model', 'basic',
-                           """ Defining what version of the model to run """)
+                           """ Defining what version of the model to run. One of: "basic", "basic_dropout",
+                           "extended", "extended_dropout", and the cheaper 7x7 convolutions "basic_separable",
+                           "basic_factorized", "extended_separable", "extended_factorized" """)
+# override the --model preset, see inference_gray.inference_segnet. '' / 0 keep the preset
+tf.app.flags.DEFINE_string('model_stages', '',
+                           """ Conv layers per encoder / decoder stage, e.g. "1,1,1" (one pool per stage) """)
+tf.app.flags.DEFINE_integer('model_channels', 0,
+                            """ Channels of every conv layer """)
+tf.app.flags.DEFINE_integer('model_kernel_size', 0,
+                            """ Size of the conv kernels """)
+tf.app.flags.DEFINE_string('precision', 'float32',
+                           """ Activation precision, one of: "float32", "float16", "bfloat16". Weights are kept float32 """)
+tf.app.flags.DEFINE_float('loss_scale', 32768.0,
+                          """ Initial loss scale for float16 training (scaled down on overflow) """)
+tf.app.flags.DEFINE_string('unpool', 'scatter',
+                           """ Unpooling layer, one of: "scatter" (scatter_nd on argmax indices), "fused" (max pool gradient kernel) """)
 
 # Training
 tf.app.flags.DEFINE_string('log_dir', "./ckpt_dir/",  # Training is default on, unless testing or finetuning is set to "True"
                            """ dir to store training ckpt """)
+tf.app.flags.DEFINE_boolean('inline_validation', True,
+                            """ Whether train runs validation every 100 steps, run evaluator.py next to training instead """)
+tf.app.flags.DEFINE_integer('eval_timeout', 0,
+                            """ Seconds evaluator.py waits for a new checkpoint before it stops, 0 waits forever """)
 # tf.app.flags.DEFINE_integer('max_steps', "60000",
 #                             """ max_steps for training """)
 
@@ -47,6 +95,8 @@ tf.app.flags.DEFINE_boolean('save_image', True,
                             """ Whether to save predicted image """)
 tf.app.flags.DEFINE_string('res_output_dir', "./result_imgs",
                            """ Directory to save result images when running test """)
+tf.app.flags.DEFINE_string('frozen_graph', '',
+                           """ Frozen graph written by export_model to run inference with, instead of a checkpoint """)
 # Finetuning
 tf.app.flags.DEFINE_boolean('finetune', False,  # True or False
                             """ Whether to finetune or not """)
@@ -86,6 +136,12 @@ tf.app.flags.DEFINE_integer('num_examples_epoch_test', "500",
                             """ num examples per epoch for test """)
 tf.app.flags.DEFINE_integer('num_examples_epoch_val', "50",
                             """ num examples per epoch for test """)
+tf.app.flags.DEFINE_boolean('sparse_labels', False,
+                            """ Use uint8 class map labels and sparse cross entropy instead of one-hot labels """)
+tf.app.flags.DEFINE_boolean('feed_inputs', False,
+                            """ Fetch training batches to numpy and feed them back through placeholders (old behaviour) """)
+tf.app.flags.DEFINE_boolean('use_tf_data', False,
+                            """ Feed the model from the tf.data pipeline instead of queue runners """)
 tf.app.flags.DEFINE_float('fraction_of_examples_in_queue', "0.1",
                           """ Fraction of examples from datasat to put in queue. Large datasets need smaller value, otherwise memory gets full. """)
 
@@ -108,7 +164,7 @@ tf.app.flags.DEFINE_float('moving_average_decay', "0.99",  # "0.9999", #https://
                           """ The decay to use for the moving average""")
 
 
-if(FLAGS.model == "basic" or FLAGS.model == "basic_dropout"):
+if(FLAGS.model.startswith("basic")):
     tf.app.flags.DEFINE_string('conv_init', 'xavier',  # xavier / var_scale
                                """ Initializer for the convolutional layers. One of: "xavier", "var_scale".  """)
     tf.app.flags.DEFINE_string('optimizer', "SGD",
@@ -124,7 +180,66 @@ NUM_EXAMPLES_PER_EPOCH_FOR_TEST = FLAGS.num_examples_epoch_test
 NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN = FLAGS.num_examples_epoch_train
 
 # FLAGS.image_h
+# step1 crops the 240x240 slices to [CROP_BD:224 - CROP_BD] -> ORIG_SIZE
+CROP_BD = 20
 ORIG_SIZE = 184
 IMAGE_SIZE = 184
 N_EPOCHS = FLAGS.num_epochs
 TEST_SPLIT = 0.2
+
+# patient level split, see split_manifest. TEST_SPLIT = 1 / N_FOLDS
+N_FOLDS = int(round(1 / TEST_SPLIT))
+TEST_FOLD = 0
+TRAIN_FOLDS = None  # None -> every fold but TEST_FOLD
+SPLIT_SEED = 42
+SPLIT_MANIFEST = './record/split_manifest.json'
+# NIfTI dir name of every patient number, written by step1
+PATIENT_INDEX = './BRATS/patients.json'
+
+# brats_metrics : per patient 3D metrics, processes (None -> one per core).
+# METRICS_SOURCE 'volumes' scores whole NIfTI volumes of the test patients,
+# 'records' only the tumour slices in the test records (optimistic)
+METRICS_WORKERS = None
+METRICS_SOURCE = 'volumes'
+BRATS_METRICS_JSON = './record/brats_metrics.json'
+
+# infer_volume : None -> the centred training crop of every slice, otherwise
+# overlapping windows at this stride covering the whole 240x240 slice
+INFER_WINDOW_STRIDE = None
+INFER_DST_DIR = './predictions/'
+# export_model : frozen, batch norm folded inference graph
+FROZEN_GRAPH = './export/frozen_model.pb'
+
+# serve : HTTP on SERVE_HOST:SERVE_PORT, or on the unix socket SERVE_SOCKET when set.
+# windows of concurrent requests are batched up to SERVE_MAX_BATCH, waiting at
+# most SERVE_MAX_LATENCY_MS for the batch to fill. SERVE_THREADS : TF intra op
+# threads (None -> one per core). A request holds at most SERVE_MAX_SLICES slices,
+# larger bodies are refused before they are read
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8500
+SERVE_SOCKET = None
+SERVE_MAX_BATCH = 32
+SERVE_MAX_LATENCY_MS = 10
+SERVE_THREADS = None
+SERVE_MAX_SLICES = 155
+
+# evaluator : polls FLAGS.log_dir every EVAL_POLL_SECS for new checkpoints,
+# summaries go to FLAGS.log_dir/EVAL_SUBDIR, metrics of every checkpoint to
+# EVAL_JSON in it. EVAL_THREADS : TF intra op threads (None -> TF default),
+# the evaluator runs on the CPU unless EVAL_ON_GPU
+EVAL_POLL_SECS = 60
+EVAL_SUBDIR = 'eval'
+EVAL_JSON = 'eval_metrics.json'
+EVAL_THREADS = None
+EVAL_ON_GPU = False
+
+# checkpoint_manager : of the checkpoints train saves, the last CKPT_KEEP_LAST,
+# one every CKPT_KEEP_HOURS hours (None : none) and the CKPT_KEEP_BEST with the
+# highest CKPT_BEST_METRIC (an evaluation.hist_metrics key) are kept. Up to
+# CKPT_MAX_PENDING not yet scored by evaluator.py are kept until they are
+CKPT_KEEP_LAST = 5
+CKPT_KEEP_HOURS = 2
+CKPT_KEEP_BEST = 3
+CKPT_BEST_METRIC = 'mean_dice'
+CKPT_MAX_PENDING = 20
+CKPT_METRICS_JSON = 'checkpoint_metrics.json'
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Streams the whole test split once through a checkpoint. The confusion matrix
+is accumulated in a local variable on the device, only the final
+num_class x num_class matrix is fetched. Reports pixel accuracy and per class
+accuracy, IoU and Dice.
+
+    python evaluate.py --model=basic [model.ckpt-N]
+"""
+
+from __future__ import division, print_function, absolute_import
+import time
+import tensorflow as tf
+
+import config
+import batch_inputs
+import evaluation
+from main_placeholder_multiclass import build_model, IMAGE_SIZE
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def evaluate_checkpoint(ckpt, record_file=None, session_config=None):
+    """
+    returns the confusion matrix (rows labels, columns predictions) of the
+    whole split, the number of examples and the seconds it took
+    """
+    record_file = record_file or batch_inputs.record_files('test')
+    with tf.Graph().as_default():
+        images, labels, _ = batch_inputs.eval_inputs(record_file, FLAGS.batch_size)
+        images, labels = batch_inputs.crop_batch(images, labels, IMAGE_SIZE, sparse_labels=True)
+        logits = build_model(images, False, 1.0)
+
+        confusion = tf.Variable(tf.zeros([FLAGS.num_class, FLAGS.num_class], dtype=tf.int64),
+                                trainable=False, name='confusion',
+                                collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        update_op = tf.assign_add(confusion, evaluation.sparse_hist(logits=logits, labels=labels))
+        n_batch = tf.shape(images)[0]
+
+        saver = tf.train.Saver()
+
+        with tf.Session(config=session_config) as sess:
+            saver.restore(sess, ckpt)
+            sess.run(tf.local_variables_initializer())
+
+            n_examples = 0
+            start_time = time.time()
+            while True:
+                try:
+                    _, n = sess.run([update_op.op, n_batch])
+                except tf.errors.OutOfRangeError:
+                    break
+                n_examples += int(n)
+            duration = time.time() - start_time
+            hist = sess.run(confusion)
+
+    return hist, n_examples, duration
+
+
+def predict_checkpoint(ckpt, record_file=None, session_config=None):
+    """
+    yields the (class maps, labels, ids) batches of one ordered pass over the
+    split, class maps and labels uint8 class indices [batch, IMAGE_SIZE, IMAGE_SIZE]
+    """
+    record_file = record_file or batch_inputs.record_files('test')
+    with tf.Graph().as_default():
+        images, labels, ids = batch_inputs.eval_inputs(record_file, FLAGS.batch_size)
+        images, labels = batch_inputs.crop_batch(images, labels, IMAGE_SIZE, sparse_labels=True)
+        logits = build_model(images, False, 1.0)
+        class_map = tf.cast(tf.argmax(logits, axis=3), tf.uint8)
+
+        saver = tf.train.Saver()
+
+        with tf.Session(config=session_config) as sess:
+            saver.restore(sess, ckpt)
+            while True:
+                try:
+                    yield sess.run([class_map, labels, ids])
+                except tf.errors.OutOfRangeError:
+                    break
+
+
+def main(argv):
+    ckpt = argv[1] if len(argv) > 1 else tf.train.latest_checkpoint(FLAGS.log_dir)
+    hist, n_examples, duration = evaluate_checkpoint(ckpt)
+
+    print('\n =====================================================')
+    print('  {} : {} test examples, {:.1f} examples/sec'.format(ckpt, n_examples,
+                                                                 n_examples / duration))
+    evaluation.print_hist_summery(hist)
+    print(' =====================================================')
+
+
+if __name__ == "__main__":
+    tf.app.run()
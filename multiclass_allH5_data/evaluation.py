@@ -87,6 +87,30 @@ def loss_calc(logits, labels):
     return cross_entropy
 
 
+def sparse_loss_calc(logits, labels):
+    """
+        logits: tensor, float - [batch_size, width, height, num_classes].
+        labels: tensor, any int type - [batch_size, width, height], class indices.
+    """
+    labels = tf.cast(labels, tf.int32)
+    cross_entropy = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        logits=logits, labels=labels))
+
+    return cross_entropy
+
+
+def sparse_hist(logits, labels):
+    """
+        in-graph fast_hist : num_class x num_class confusion matrix of the batch,
+        rows are labels, columns predictions.
+        labels: tensor, any int type - [batch_size, width, height], class indices.
+    """
+    num_class = logits.get_shape().as_list()[3]
+    predictions = tf.reshape(tf.argmax(logits, axis=3, output_type=tf.int32), [-1])
+    labels = tf.reshape(tf.cast(labels, tf.int32), [-1])
+    return tf.confusion_matrix(labels, predictions, num_classes=num_class, dtype=tf.int64)
+
+
 def weighted_loss_calc(logits, labels):
     class_weights = np.array([
         FLAGS.balance_weight_0,  # "Not building"
@@ -108,12 +132,8 @@ def evaluation(logits, labels):
 
 
 def per_class_acc(predictions, label_tensor):
-    labels = label_tensor
+    hist = batch_hist(predictions, label_tensor, FLAGS.num_class).astype(np.float64)
     num_class = FLAGS.num_class
-    size = predictions.shape[0]
-    hist = np.zeros((num_class, num_class))
-    for i in range(size):
-        hist += fast_hist(labels[i].flatten(), predictions[i].argmax(2).flatten(), num_class)
     acc_total = np.diag(hist).sum() / hist.sum()
     print ('accuracy = %f' % np.nanmean(acc_total))
     iu = np.diag(hist) / (hist.sum(1) + hist.sum(0) - np.diag(hist))
@@ -132,22 +152,93 @@ def fast_hist(a, b, n):
 
 
 def get_hist(predictions, labels):
-    num_class = predictions.shape[3]  # becomes 2 for aerial - correct
-    batch_size = predictions.shape[0]
-    hist = np.zeros((num_class, num_class))
-    for i in range(batch_size):
-        hist += fast_hist(labels[i].flatten(), predictions[i].argmax(2).flatten(), num_class)
-    return hist
+    return batch_hist(predictions, labels).astype(np.float64)
+
+
+def batch_hist(predictions, labels, num_class=None):
+    """
+        confusion matrix (rows labels, columns predictions) of a whole batch
+        with one argmax and one bincount.
+        predictions: [batch, h, w, num_class] scores, or [batch, h, w] class maps
+                of class indices (not BraTS labels), ValueError outside [0, num_class)
+        labels: [batch, h, w] class indices, any int dtype (uint8 / int8 too).
+                labels outside [0, num_class) are ignored
+        num_class: defaults to the scores depth, FLAGS.num_class for class maps
+    """
+    if predictions.ndim == 4:
+        num_class = num_class or predictions.shape[3]
+        predictions = predictions.argmax(3)
+    else:
+        num_class = num_class or FLAGS.num_class
+        if predictions.size and (predictions.min() < 0 or predictions.max() >= num_class):
+            raise ValueError("Class map values must be class indices in [0, {}), got [{}, {}]".format(
+                num_class, predictions.min(), predictions.max()))
+
+    # the flat bin index fits the smallest dtype holding num_class**2
+    idx_dtype = np.min_scalar_type(num_class ** 2 - 1)
+    labels = np.ravel(labels)
+    idx = labels.astype(idx_dtype) * idx_dtype.type(num_class)
+    idx += np.ravel(predictions).astype(idx_dtype, copy=False)
+    valid = (labels >= 0) & (labels < num_class)
+    if not valid.all():
+        idx = idx[valid]
+    return np.bincount(idx, minlength=num_class ** 2).reshape(num_class, num_class)
+
+
+class HistAccumulator(object):
+    '''
+    Running confusion matrix over many batches. Accumulators of different
+    workers / processes (it pickles) are combined with merge.
+    '''
+
+    def __init__(self, num_class=None):
+        self.num_class = num_class or FLAGS.num_class
+        self.hist = np.zeros((self.num_class, self.num_class), dtype=np.int64)
+
+    def update(self, predictions, labels):
+        # scores or class maps, see batch_hist
+        self.hist += batch_hist(predictions, labels, self.num_class)
+        return self
+
+    def add(self, hist):
+        # a precomputed confusion matrix, e.g. fetched from sparse_hist
+        self.hist += np.asarray(hist, dtype=np.int64)
+        return self
+
+    def merge(self, other):
+        return self.add(other.hist)
+
+    def metrics(self):
+        return hist_metrics(self.hist)
+
+
+def hist_metrics(hist):
+    """
+        pixel accuracy, and per class accuracy (recall), IoU and Dice of a
+        confusion matrix (rows labels, columns predictions). classes absent
+        from both labels and predictions get nan IoU / Dice, left out of the means
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    tp = np.diag(hist)
+    n_label = hist.sum(1)
+    n_pred = hist.sum(0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acc = np.where(n_label > 0, tp / n_label, 0.0)
+        iou = tp / (n_label + n_pred - tp)
+        dice = 2 * tp / (n_label + n_pred)
+    return {'accuracy': tp.sum() / hist.sum(),
+            'class_accuracy': acc.tolist(),
+            'iou': iou.tolist(),
+            'dice': dice.tolist(),
+            'mean_iou': np.nanmean(iou),
+            'mean_dice': np.nanmean(dice)}
 
 
 def print_hist_summery(hist):
-    acc_total = np.diag(hist).sum() / hist.sum()
-    print ('accuracy = %f' % np.nanmean(acc_total))
-    iu = np.diag(hist) / (hist.sum(1) + hist.sum(0) - np.diag(hist))
-    print ('mean IU  = %f' % np.nanmean(iu))
+    metrics = hist_metrics(hist)
+    print ('accuracy = %f' % metrics['accuracy'])
+    print ('mean IU  = %f' % metrics['mean_iou'])
+    print ('mean Dice = %f' % metrics['mean_dice'])
     for ii in range(hist.shape[0]):
-        if float(hist.sum(1)[ii]) == 0:
-            acc = 0.0
-        else:
-            acc = np.diag(hist)[ii] / float(hist.sum(1)[ii])
-        print("    class # %d accuracy = %f " % (ii, acc))
+        print("    class # %d accuracy = %f, IU = %f, Dice = %f " % (ii, metrics['class_accuracy'][ii],
+                                                                    metrics['iou'][ii], metrics['dice'][ii]))
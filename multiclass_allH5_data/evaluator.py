@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint evaluator, run next to training (with --inline_validation=False)
+in its own process : every model.ckpt-* in --log_dir is streamed once
+through the test split (evaluate.evaluate_checkpoint), its metrics written as
+summaries to log_dir/eval and to log_dir/eval/eval_metrics.json.
+
+    python evaluator.py --model=basic [--log_dir=./ckpt_dir/]
+
+Stops once no new checkpoint shows up for --eval_timeout seconds (0 : never).
+Checkpoints already in eval_metrics.json are not evaluated again.
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import json
+import time
+import tensorflow as tf
+
+import config
+import evaluation
+from evaluate import evaluate_checkpoint
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def step_of(ckpt):
+    # model.ckpt-N -> N
+    return int(ckpt.split('-')[-1])
+
+
+def read_metrics(eval_dir):
+    """
+    returns {checkpoint name: metrics} of every checkpoint evaluated so far
+    """
+    path = os.path.join(eval_dir, config.EVAL_JSON)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_metrics(eval_dir, all_metrics):
+    # written aside and renamed, readers never see a partial file
+    path = os.path.join(eval_dir, config.EVAL_JSON)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(all_metrics, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def metrics_summary(metrics):
+    values = [tf.Summary.Value(tag='eval/' + name, simple_value=metrics[name])
+              for name in ['accuracy', 'mean_iou', 'mean_dice', 'examples_per_sec']]
+    for name in ['iou', 'dice']:
+        values += [tf.Summary.Value(tag='eval/{}_class_{}'.format(name, c), simple_value=v)
+                   for c, v in enumerate(metrics[name])]
+    return tf.Summary(value=values)
+
+
+def main(argv):
+    eval_dir = os.path.join(FLAGS.log_dir, config.EVAL_SUBDIR)
+    if not os.path.exists(eval_dir):
+        os.makedirs(eval_dir)
+    # its own thread budget, so it does not starve the training process
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=config.EVAL_THREADS or 0,
+                                    inter_op_parallelism_threads=2)
+    if not config.EVAL_ON_GPU:
+        session_config.device_count['GPU'] = 0
+
+    all_metrics = read_metrics(eval_dir)
+    writer = tf.summary.FileWriter(eval_dir)
+    print('Watching {} for checkpoints, {} evaluated so far'.format(FLAGS.log_dir, len(all_metrics)))
+    sys.stdout.flush()
+
+    for latest in tf.contrib.training.checkpoints_iterator(FLAGS.log_dir,
+                                                           min_interval_secs=config.EVAL_POLL_SECS,
+                                                           timeout=FLAGS.eval_timeout or None):
+        # every checkpoint still listed, not only the latest : checkpoint_manager
+        # keeps the ones not scored yet for best-k
+        state = tf.train.get_checkpoint_state(FLAGS.log_dir)
+        ckpts = list(state.all_model_checkpoint_paths) if state else []
+        if latest not in ckpts:
+            ckpts.append(latest)
+        for ckpt in ckpts:
+            name = os.path.basename(ckpt)
+            if name in all_metrics:
+                continue
+            try:
+                hist, n_examples, duration = evaluate_checkpoint(ckpt, session_config=session_config)
+            except tf.errors.NotFoundError:
+                # deleted by the training process before it was evaluated
+                print('{} is gone, skipped'.format(name))
+                continue
+
+            metrics = evaluation.hist_metrics(hist)
+            metrics.update(step=step_of(ckpt), examples=n_examples,
+                           examples_per_sec=n_examples / duration, time=time.time())
+            all_metrics[name] = metrics
+            write_metrics(eval_dir, all_metrics)
+            writer.add_summary(metrics_summary(metrics), metrics['step'])
+            writer.flush()
+
+            print('\n =====================================================')
+            print('  {} : {} test examples, {:.1f} examples/sec'.format(ckpt, n_examples,
+                                                                         n_examples / duration))
+            evaluation.print_hist_summery(hist)
+            print(' =====================================================')
+            sys.stdout.flush()
+    writer.close()
+
+
+if __name__ == "__main__":
+    tf.app.run()
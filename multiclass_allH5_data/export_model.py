@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Turns a training checkpoint into a frozen inference graph : variables become
+constants, batch norms are folded into their convolutions, constants are folded
+and everything the 'images' -> 'class_map' / 'probs' path does not need is
+pruned (input pipeline, labels, loss, optimizer, is_training / keep_prob).
+
+    python export_model.py --model=basic [model.ckpt-N]
+
+load_frozen_graph starts an inference session from the .pb without building
+the model or restoring a checkpoint.
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+
+import config
+import inference_gray
+from main_placeholder_multiclass import build_model
+
+FLAGS = tf.app.flags.FLAGS
+
+INPUT_NAME = 'images'
+OUTPUT_NAMES = ['class_map', 'probs']
+
+
+def build_inference_graph():
+    # python False / 1.0 : frozen batch norm statistics, no dropout ops
+    images = tf.placeholder(tf.float32, name=INPUT_NAME,
+                            shape=[None, FLAGS.image_h, FLAGS.image_w, FLAGS.image_c])
+    logits = build_model(images, False, 1.0)
+    tf.argmax(logits, axis=3, name=OUTPUT_NAMES[0])
+    tf.nn.softmax(logits, name=OUTPUT_NAMES[1])
+    return images
+
+
+def _fold_constants(graph_def):
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        print('graph_transforms is not available, constants are not folded')
+        return graph_def
+    return TransformGraph(graph_def, [INPUT_NAME], OUTPUT_NAMES,
+                          ['remove_nodes(op=Identity, op=CheckNumerics)',
+                           'fold_constants(ignore_errors=true)',
+                           'strip_unused_nodes'])
+
+
+def export_frozen_graph(ckpt, dst_path=config.FROZEN_GRAPH):
+    with tf.Graph().as_default() as graph:
+        build_inference_graph()
+        saver = tf.train.Saver()
+        with tf.Session() as sess:
+            saver.restore(sess, ckpt)
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(),
+                                                                     OUTPUT_NAMES)
+    n_nodes = len(graph_def.node)
+    graph_def = inference_gray.fold_batch_norms(graph_def, OUTPUT_NAMES)
+    graph_def = _fold_constants(graph_def)
+
+    dst_dir = os.path.dirname(dst_path)
+    if dst_dir and not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    with tf.gfile.GFile(dst_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    print('{} -> {} : {} -> {} nodes, {:.1f} MB'.format(ckpt, dst_path, n_nodes, len(graph_def.node),
+                                                       os.path.getsize(dst_path) / 2.0**20))
+
+
+def load_frozen_graph(path=config.FROZEN_GRAPH):
+    """
+    returns the graph and its images input, class_map and probs outputs
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    with tf.Graph().as_default() as graph:
+        images, class_map, probs = tf.import_graph_def(
+            graph_def, name='', return_elements=[name + ':0' for name in [INPUT_NAME] + OUTPUT_NAMES])
+    return graph, images, class_map, probs
+
+
+def _startup_sec(start_session):
+    # time until the first batch is segmented
+    images_batch = np.zeros((1, FLAGS.image_h, FLAGS.image_w, FLAGS.image_c), dtype=np.float32)
+    start_time = time.time()
+    sess, images, class_map = start_session()
+    sess.run(class_map, feed_dict={images: images_batch})
+    duration = time.time() - start_time
+    sess.close()
+    return duration
+
+
+def main(argv):
+    ckpt = argv[1] if len(argv) > 1 else tf.train.latest_checkpoint(FLAGS.log_dir)
+    if ckpt is None:
+        sys.exit("No checkpoint in {}, pass one or set --log_dir".format(FLAGS.log_dir))
+    export_frozen_graph(ckpt)
+
+    def from_checkpoint():
+        graph = tf.Graph()
+        with graph.as_default():
+            images = build_inference_graph()
+            class_map = graph.get_tensor_by_name(OUTPUT_NAMES[0] + ':0')
+            saver = tf.train.Saver()
+        sess = tf.Session(graph=graph)
+        saver.restore(sess, ckpt)
+        return sess, images, class_map
+
+    def from_frozen_graph():
+        graph, images, class_map, _ = load_frozen_graph()
+        return tf.Session(graph=graph), images, class_map
+
+    ckpt_sec = _startup_sec(from_checkpoint)
+    frozen_sec = _startup_sec(from_frozen_graph)
+    print('\n =====================================================')
+    print('  startup to first batch, model: {}'.format(FLAGS.model))
+    print('    checkpoint   : {:.2f} sec'.format(ckpt_sec))
+    print('    frozen graph : {:.2f} sec ({:.1f}x)'.format(frozen_sec, ckpt_sec / frozen_sec))
+    print(' =====================================================')
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    tf.app.run()
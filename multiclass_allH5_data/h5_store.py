@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function, absolute_import
+import sys
+import numpy as np
+import h5py
+
+import config
+
+
+IMAGES = 'images'
+LABELS = 'labels'
+IDS = 'ids'
+
+
+def slice_id(patient_num, slice_ix):
+    # same naming as the one-file-per-slice layout, so ids stay interchangeable
+    return 'HGG_patient_{}_{}_.h5'.format(patient_num, slice_ix)
+
+
+class H5SliceWriter(object):
+    '''
+    Appends tumour slices to one chunked, compressed HDF5 file holding
+        images [N, size, size, 4]  float32
+        labels [N, size, size]     uint8
+        ids    [N]                 str, see slice_id
+    every dataset is resizable along N, one chunk per slice
+    '''
+
+    def __init__(self, path, size=config.ORIG_SIZE, n_channels=4,
+                 compression='gzip', compression_opts=4):
+        self.path = path
+        self.h5f = h5py.File(path, 'w')
+        self.images = self.h5f.create_dataset(IMAGES,
+                                              shape=(0, size, size, n_channels),
+                                              maxshape=(None, size, size, n_channels),
+                                              chunks=(1, size, size, n_channels),
+                                              dtype=np.float32,
+                                              compression=compression,
+                                              compression_opts=compression_opts,
+                                              shuffle=True)
+        self.labels = self.h5f.create_dataset(LABELS,
+                                              shape=(0, size, size),
+                                              maxshape=(None, size, size),
+                                              chunks=(1, size, size),
+                                              dtype=np.uint8,
+                                              compression=compression,
+                                              compression_opts=compression_opts)
+        self.ids = self.h5f.create_dataset(IDS,
+                                           shape=(0,),
+                                           maxshape=(None,),
+                                           chunks=(1024,),
+                                           dtype=h5py.special_dtype(vlen=str))
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def append(self, images, labels, ids):
+        start = len(self)
+        stop = start + len(ids)
+        for dataset, data in ((self.images, images),
+                              (self.labels, labels),
+                              (self.ids, ids)):
+            dataset.resize(stop, axis=0)
+            dataset[start:stop] = data
+
+    def close(self):
+        self.h5f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class H5SliceStore(object):
+    '''
+    Read side of H5SliceWriter. The file stays open for the lifetime of the
+    store, so any subset of slices is read without reopening files.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.h5f = h5py.File(path, 'r')
+        self.images = self.h5f[IMAGES]
+        self.labels = self.h5f[LABELS]
+        self.ids = self.h5f[IDS]
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def __getitem__(self, idx):
+        '''
+        idx: int, slice or array of indices in any order (duplicates allowed)
+        returns images, labels, ids
+        '''
+        if isinstance(idx, (int, np.integer, slice)):
+            return self.images[idx], self.labels[idx], self.ids[idx]
+
+        # h5py fancy indexing wants unique, increasing indices
+        idx = np.asarray(idx, dtype=np.int64)
+        uniq, inverse = np.unique(idx, return_inverse=True)
+        uniq = uniq.tolist()
+        return (self.images[uniq][inverse],
+                self.labels[uniq][inverse],
+                np.asarray(self.ids[uniq])[inverse])
+
+    def iter_batches(self, batch_size, indices=None):
+        if indices is None:
+            for start in range(0, len(self), batch_size):
+                yield self[start:start + batch_size]
+        else:
+            for start in range(0, len(indices), batch_size):
+                yield self[indices[start:start + batch_size]]
+
+    def close(self):
+        self.h5f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_store(path):
+    '''
+    reads the whole store into memory : images, int32 labels and ids arrays
+    '''
+    print('Reading images from store ', path)
+
+    with H5SliceStore(path) as store:
+        images = store.images[:]
+        labels = store.labels[:].astype(np.int32)
+        ids = np.asarray(store.ids[:])
+
+    print('images shape : ', images.shape)
+    print('labels shape : ', labels.shape)
+
+    return images, labels, ids
+
+
+def merge_stores(src_paths, dst_path, batch_size=256):
+    '''
+    concatenates per-patient stores into one store
+    '''
+    with H5SliceWriter(dst_path) as writer:
+        for n, src_path in enumerate(src_paths):
+            with H5SliceStore(src_path) as store:
+                for images, labels, ids in store.iter_batches(batch_size):
+                    writer.append(images, labels, ids)
+            print('merged {}/{} : {}'.format(n + 1, len(src_paths), src_path))
+            sys.stdout.flush()
+        print('{} slices written to {}'.format(len(writer), dst_path))
+
+
+if __name__ == '__main__':
+
+    store_path = sys.argv[1] if len(sys.argv) > 1 else config.H5_STORE
+    with H5SliceStore(store_path) as store:
+        print('slices : ', len(store))
+        images, labels, ids = store[[5, 0, 5]]
+        print('images : ', images.shape, images.dtype)
+        print('labels : ', labels.shape, labels.dtype, np.unique(labels))
+        print('ids : ', ids)
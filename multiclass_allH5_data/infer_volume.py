@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Whole volume segmentation : every axial slice of a patient goes through the
+model, the class maps are put back into a 155x240x240 BraTS label volume and
+written as NIfTI next to the input geometry.
+
+    python infer_volume.py --model=basic --batch_size=32 patient_dir [patient_dir ...]
+
+patient_dir has the layout BrainPipeline.read_scans expects (the *_seg file is
+not needed). Without patient dirs every patient of config.SRC_NIFTY_DIR is done.
+"""
+
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import time
+from glob import glob
+import numpy as np
+import tensorflow as tf
+import SimpleITK as sitk
+
+import config
+import export_model
+from main_placeholder_multiclass import build_model, IMAGE_SIZE
+
+FLAGS = tf.app.flags.FLAGS
+
+# channel order of the records, see config.MODALITY_DICT
+MODALITIES = ['flair', 't1', 't1ce', 't2']
+SLICE_SIZE = 240
+
+
+def read_volume(path):
+    """
+    returns the (155, 240, 240, 4) float32 modalities of the patient dir and
+    the flair image, whose geometry the prediction is written with
+    """
+    scans = [sitk.ReadImage(glob(os.path.join(path, '*_{}.nii.gz'.format(mod)))[0])
+             for mod in MODALITIES]
+    volume = np.stack([sitk.GetArrayFromImage(scan) for scan in scans], axis=-1)
+    return volume.astype(np.float32), scans[0]
+
+
+def normalize_volume(volume):
+    # the step1 'reg' preprocessing : every slice of every modality divided by its max
+    maxes = volume.max(axis=(1, 2), keepdims=True)
+    maxes[maxes == 0] = 1
+    return volume / maxes
+
+
+def write_volume(labels, reference, dst_path):
+    image = sitk.GetImageFromArray(labels)
+    image.CopyInformation(reference)
+    sitk.WriteImage(image, dst_path)
+
+
+class VolumeSegmenter(object):
+    '''
+    Holds the inference graph and a session, restored from a checkpoint or
+    loaded from a frozen graph (export_model).
+    Slices are cut into IMAGE_SIZE windows (the centred training crop, or
+    overlapping windows at window_stride), run in batches of batch_size and
+    the softmax scores of overlapping windows summed.
+    '''
+
+    def __init__(self, ckpt=None, batch_size=None, window_stride=config.INFER_WINDOW_STRIDE,
+                 frozen_graph=None, session_config=None):
+        self.batch_size = batch_size or FLAGS.batch_size
+        self.windows = self._windows(window_stride)
+        if frozen_graph:
+            print('Loading ', frozen_graph)
+            self.graph, self.images, _, self.probs = export_model.load_frozen_graph(frozen_graph)
+            self.sess = tf.Session(graph=self.graph, config=session_config)
+            return
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.images = tf.placeholder(tf.float32,
+                                         shape=[None, IMAGE_SIZE, IMAGE_SIZE, FLAGS.image_c])
+            logits = build_model(self.images, False, 1.0)
+            self.probs = tf.nn.softmax(logits)
+            saver = tf.train.Saver()
+        self.sess = tf.Session(graph=self.graph, config=session_config)
+        ckpt = ckpt or tf.train.latest_checkpoint(FLAGS.log_dir)
+        print('Restoring ', ckpt)
+        saver.restore(self.sess, ckpt)
+
+    @staticmethod
+    def _windows(window_stride):
+        if window_stride is None:
+            # where the 184 step1 crop and the model's centre crop put the training window
+            start = config.CROP_BD + (config.ORIG_SIZE - IMAGE_SIZE) // 2
+            return [(start, start)]
+        starts = list(range(0, SLICE_SIZE - IMAGE_SIZE, window_stride)) + [SLICE_SIZE - IMAGE_SIZE]
+        return [(y, x) for y in starts for x in starts]
+
+    def predict(self, images):
+        # (n, IMAGE_SIZE, IMAGE_SIZE, 4) windows -> (n, IMAGE_SIZE, IMAGE_SIZE, num_class) softmax
+        return self.sess.run(self.probs, feed_dict={self.images: images})
+
+    def segment_slices(self, slices):
+        '''
+        slices: (n, 240, 240, 4) normalized slices
+        returns the (n, 240, 240) class maps, class 0 outside every window
+        '''
+        scores = np.zeros(slices.shape[:3] + (FLAGS.num_class,), dtype=np.float32)
+        jobs = [(i, y, x) for i in range(len(slices)) for y, x in self.windows]
+        for start in range(0, len(jobs), self.batch_size):
+            batch = jobs[start:start + self.batch_size]
+            images = np.stack([slices[i, y:y + IMAGE_SIZE, x:x + IMAGE_SIZE] for i, y, x in batch])
+            probs = self.predict(images)
+            for (i, y, x), prob in zip(batch, probs):
+                scores[i, y:y + IMAGE_SIZE, x:x + IMAGE_SIZE] += prob
+        return scores.argmax(axis=-1)
+
+    def segment_volume(self, volume):
+        '''
+        volume: (155, 240, 240, 4) raw modalities
+        returns the (155, 240, 240) uint8 BraTS label volume
+        '''
+        classes = self.segment_slices(normalize_volume(volume))
+        return np.asarray(config.CLASS_LABELS, dtype=np.uint8)[classes]
+
+    def close(self):
+        self.sess.close()
+
+
+def segment_patient(segmenter, path, dst_dir=config.INFER_DST_DIR):
+    patient = os.path.basename(os.path.normpath(path))
+    volume, reference = read_volume(path)
+
+    start_time = time.time()
+    labels = segmenter.segment_volume(volume)
+    duration = time.time() - start_time
+
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    dst_path = os.path.join(dst_dir, '{}_pred.nii.gz'.format(patient))
+    write_volume(labels, reference, dst_path)
+    print('{} : {} slices, {:.1f} slices/sec -> {}'.format(patient, len(volume),
+                                                            len(volume) / duration, dst_path))
+    sys.stdout.flush()
+    return len(volume), duration
+
+
+def main(argv):
+    patients = argv[1:] or glob(config.SRC_NIFTY_DIR)
+    segmenter = VolumeSegmenter(frozen_graph=FLAGS.frozen_graph)
+    n_slices, duration = 0, 0.0
+    for path in patients:
+        n, sec = segment_patient(segmenter, path)
+        n_slices += n
+        duration += sec
+    segmenter.close()
+
+    print('\n =====================================================')
+    print('  {} patients, {} windows per slice, batch size {}'.format(
+        len(patients), len(segmenter.windows), segmenter.batch_size))
+    print('  {:.1f} slices/sec'.format(n_slices / duration))
+    print(' =====================================================')
+
+
+if __name__ == "__main__":
+    tf.app.run()
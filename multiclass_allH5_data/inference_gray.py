@@ -1,34 +1,43 @@
 import tensorflow as tf
 import numpy as np
+from tensorflow.python.ops import gen_nn_ops
+from tensorflow.python.framework import tensor_util
 
 FLAGS = tf.app.flags.FLAGS
 
 
-def unpool_with_argmax(pool, ind, name=None, ksize=[1, 2, 2, 1]):
+def unpool_with_argmax(pool, ind, name=None, ksize=[1, 2, 2, 1], like=None):
     """
        Unpooling layer after max_pool_with_argmax.
+       Works for any batch size : the batch dimension (and the spatial ones, if
+       unknown) are read from the tensor at run time instead of FLAGS.batch_size.
        Args:
            pool:   max pooled output tensor
            ind:      argmax indices
            ksize:     ksize is the same as for the pool
+           like:     optional, the tensor that was pooled. Gives the output shape,
+                     so odd sizes unpool back to their size (11 -> 6 -> 11, not 12)
        Return:
            unpool:    unpooling tensor
     """
-    tmp_batch_size = FLAGS.batch_size
     with tf.variable_scope(name):
-        input_shape = pool.get_shape().as_list()
-        output_shape = (tmp_batch_size,
-                        input_shape[1] * ksize[1],
-                        input_shape[2] * ksize[2],
-                        input_shape[3])
+        input_shape = tf.shape(pool, out_type=ind.dtype)
+        if like is None:
+            output_shape = [input_shape[0],
+                            input_shape[1] * ksize[1],
+                            input_shape[2] * ksize[2],
+                            input_shape[3]]
+        else:
+            like_shape = tf.shape(like, out_type=ind.dtype)
+            output_shape = [like_shape[0], like_shape[1], like_shape[2], like_shape[3]]
 
-        flat_input_size = np.prod(input_shape[1:]) * tmp_batch_size
-        flat_output_shape = [output_shape[0],
-                             output_shape[1] * output_shape[2] * output_shape[3]]
+        flat_input_size = tf.reduce_prod(input_shape)
+        flat_output_shape = tf.stack([output_shape[0],
+                                      output_shape[1] * output_shape[2] * output_shape[3]])
 
         pool_ = tf.reshape(pool, [flat_input_size])
         batch_range = tf.reshape(tf.range(output_shape[0], dtype=ind.dtype),
-                                 shape=[tmp_batch_size, 1, 1, 1])
+                                 shape=[-1, 1, 1, 1])
 
         b = tf.ones_like(ind) * batch_range
         b = tf.reshape(b, [flat_input_size, 1])
@@ -36,19 +45,99 @@ def unpool_with_argmax(pool, ind, name=None, ksize=[1, 2, 2, 1]):
         ind_ = tf.concat([b, ind_], 1)
 
         ret = tf.scatter_nd(ind_, pool_, shape=flat_output_shape)
-        ret = tf.reshape(ret, output_shape)
+        ret = tf.reshape(ret, tf.stack(output_shape))
+
+        # keep whatever is known statically, the conv layers need the channels
+        if like is not None:
+            ret.set_shape(like.get_shape())
+            return ret
+        static_shape = pool.get_shape().as_list()
+        ret.set_shape([static_shape[0],
+                       static_shape[1] * ksize[1] if static_shape[1] is not None else None,
+                       static_shape[2] * ksize[2] if static_shape[2] is not None else None,
+                       static_shape[3]])
         return ret
 
 
+def unpool_with_argmax_fused(pool, ind, like, name=None, ksize=[1, 2, 2, 1]):
+    """
+       Same unpooling as unpool_with_argmax, done by the max pool gradient
+       kernel : pool values are routed straight to their argmax positions, no
+       [N, 2] index matrix, batch range or scatter_nd buffers are built.
+       Args:
+           pool:   max pooled output tensor
+           ind:      argmax indices
+           like:     the tensor that was pooled, gives the output shape
+           ksize:     ksize is the same as for the pool
+       Return:
+           unpool:    unpooling tensor, shaped like `like`
+       max_pool_grad_with_argmax is not public API and its argmax layout
+       (include_batch_in_index) has changed between TF versions :
+       test_inference_gray.py checks it against unpool_with_argmax, run it
+       before training with --unpool=fused on another TF version.
+    """
+    with tf.variable_scope(name):
+        # only the shape of `like` is used, nothing should flow back into it
+        return gen_nn_ops.max_pool_grad_with_argmax(tf.stop_gradient(like), pool, ind,
+                                                    ksize=ksize, strides=ksize,
+                                                    padding='SAME')
+
+
+def max_pool(net, name=None):
+    """
+    2x2 max pool, returns the pooled tensor and its argmax indices.
+    max_pool_with_argmax has no bfloat16 kernel in TF 1.x, bfloat16 activations
+    are pooled in float32
+    """
+    dtype = net.dtype
+    if dtype == tf.bfloat16:
+        net = tf.cast(net, tf.float32)
+    net, indices = tf.nn.max_pool_with_argmax(net, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1],
+                                              padding='SAME', name=name)
+    return tf.cast(net, dtype), indices
+
+
+def unpool(pool, ind, like, name=None, ksize=[1, 2, 2, 1]):
+    # FLAGS.unpool : 'scatter' (unpool_with_argmax) or 'fused' (unpool_with_argmax_fused)
+    # neither has a bfloat16 kernel in TF 1.x, bfloat16 activations are unpooled in float32
+    dtype = pool.dtype
+    if dtype == tf.bfloat16:
+        pool, like = tf.cast(pool, tf.float32), tf.cast(like, tf.float32)
+    if FLAGS.unpool == "scatter":
+        net = unpool_with_argmax(pool, ind, name=name, ksize=ksize, like=like)
+    elif FLAGS.unpool == "fused":
+        net = unpool_with_argmax_fused(pool, ind, like, name=name, ksize=ksize)
+    else:
+        raise ValueError("The selected unpool layer does not exist")
+    return tf.cast(net, dtype)
+
+
+def activation_dtype():
+    """
+    dtype of the activations under FLAGS.precision. Variables are always
+    created float32 (master weights) and cast where they are used.
+    """
+    if FLAGS.precision == "float32":
+        return tf.float32
+    elif FLAGS.precision == "float16":
+        return tf.float16
+    elif FLAGS.precision == "bfloat16":
+        return tf.bfloat16
+    else:
+        raise ValueError("The selected precision does not exist")
+
+
 def conv_classifier(input_layer, initializer):
     # output predicted class number (2)
     with tf.variable_scope('conv_classifier') as scope:  # all variables prefixed with "conv_classifier/"
-        shape = [1, 1, 64, FLAGS.num_class]
+        shape = [1, 1, input_layer.get_shape().as_list()[3], FLAGS.num_class]
         kernel = _variable_with_weight_decay('weights', shape=shape, initializer=initializer, wd=None)
         #kernel = tf.get_variable('weights', shape, initializer=initializer)
-        conv = tf.nn.conv2d(input_layer, filter=kernel, strides=[1, 1, 1, 1], padding='SAME')
+        conv = tf.nn.conv2d(input_layer, filter=tf.cast(kernel, input_layer.dtype),
+                            strides=[1, 1, 1, 1], padding='SAME')
         biases = _variable_on_cpu('biases', [FLAGS.num_class], tf.constant_initializer(0.0))
-        conv_classifier = tf.nn.bias_add(conv, biases, name=scope.name)
+        # logits always leave the model as float32, the loss and softmax run in full precision
+        conv_classifier = tf.nn.bias_add(tf.cast(conv, tf.float32), biases, name=scope.name)
     return conv_classifier
 
 
@@ -60,10 +149,65 @@ def conv_layer_with_bn(initializer, inputT, shape, is_training, activation=True,
     with tf.variable_scope(name) as scope:
         kernel = _variable_with_weight_decay('weights', shape=shape, initializer=initializer, wd=None)
         #kernel = tf.get_variable(scope.name, shape, initializer=initializer)
-        conv = tf.nn.conv2d(inputT, kernel, [1, 1, 1, 1], padding='SAME')
+        conv = tf.nn.conv2d(inputT, tf.cast(kernel, inputT.dtype), [1, 1, 1, 1], padding='SAME')
         biases = tf.Variable(tf.constant(0.0, shape=[out_channel], dtype=tf.float32),
                              trainable=True, name='biases')
-        bias = tf.nn.bias_add(conv, biases)
+        bias = tf.nn.bias_add(conv, tf.cast(biases, conv.dtype))
+
+        if activation is True:  # only use relu during encoder
+            conv_out = tf.nn.relu(batch_norm_layer(bias, is_training, scope.name))
+        else:
+            conv_out = batch_norm_layer(bias, is_training, scope.name)
+    return conv_out
+
+
+def separable_conv_layer_with_bn(initializer, inputT, shape, is_training, activation=True, name=None):
+    """
+    conv_layer_with_bn with the [k, k, in, out] kernel replaced by a [k, k, in, 1]
+    depthwise and a [1, 1, in, out] pointwise kernel : k*k*in + in*out instead
+    of k*k*in*out MACs per output pixel
+    """
+    in_channel = shape[2]
+    out_channel = shape[3]
+    k_size = shape[0]
+
+    with tf.variable_scope(name) as scope:
+        depthwise = _variable_with_weight_decay('depthwise_weights', shape=[k_size, k_size, in_channel, 1],
+                                                initializer=initializer, wd=None)
+        pointwise = _variable_with_weight_decay('pointwise_weights', shape=[1, 1, in_channel, out_channel],
+                                                initializer=initializer, wd=None)
+        conv = tf.nn.separable_conv2d(inputT, tf.cast(depthwise, inputT.dtype), tf.cast(pointwise, inputT.dtype),
+                                      [1, 1, 1, 1], padding='SAME')
+        biases = tf.Variable(tf.constant(0.0, shape=[out_channel], dtype=tf.float32),
+                             trainable=True, name='biases')
+        bias = tf.nn.bias_add(conv, tf.cast(biases, conv.dtype))
+
+        if activation is True:  # only use relu during encoder
+            conv_out = tf.nn.relu(batch_norm_layer(bias, is_training, scope.name))
+        else:
+            conv_out = batch_norm_layer(bias, is_training, scope.name)
+    return conv_out
+
+
+def factorized_conv_layer_with_bn(initializer, inputT, shape, is_training, activation=True, name=None):
+    """
+    conv_layer_with_bn with the k x k convolution factorized into k x 1 followed
+    by 1 x k (no non-linearity in between) : k*in*out + k*out*out MACs per output pixel
+    """
+    in_channel = shape[2]
+    out_channel = shape[3]
+    k_size = shape[0]
+
+    with tf.variable_scope(name) as scope:
+        kernel_v = _variable_with_weight_decay('weights_v', shape=[k_size, 1, in_channel, out_channel],
+                                               initializer=initializer, wd=None)
+        kernel_h = _variable_with_weight_decay('weights_h', shape=[1, k_size, out_channel, out_channel],
+                                               initializer=initializer, wd=None)
+        conv = tf.nn.conv2d(inputT, tf.cast(kernel_v, inputT.dtype), [1, 1, 1, 1], padding='SAME')
+        conv = tf.nn.conv2d(conv, tf.cast(kernel_h, conv.dtype), [1, 1, 1, 1], padding='SAME')
+        biases = tf.Variable(tf.constant(0.0, shape=[out_channel], dtype=tf.float32),
+                             trainable=True, name='biases')
+        bias = tf.nn.bias_add(conv, tf.cast(biases, conv.dtype))
 
         if activation is True:  # only use relu during encoder
             conv_out = tf.nn.relu(batch_norm_layer(bias, is_training, scope.name))
@@ -73,11 +217,103 @@ def conv_layer_with_bn(initializer, inputT, shape, is_training, activation=True,
 
 
 def batch_norm_layer(inputT, is_training, scope):
-    return tf.cond(is_training,
-                   lambda: tf.contrib.layers.batch_norm(inputT, is_training=True,
-                                                        center=False, decay=FLAGS.moving_average_decay, scope=scope),
-                   lambda: tf.contrib.layers.batch_norm(inputT, is_training=False,
-                                                        center=False, reuse=True, decay=FLAGS.moving_average_decay, scope=scope))
+    """
+    One fused batch norm call per layer. is_training is a python bool or a bool tensor.
+    A python bool builds that path only : False is the frozen statistics path
+    fold_batch_norms folds into the preceding conv at export, True the batch
+    statistics one.
+    A tensor (train with inline validation) goes through smart_cond : the layer
+    still holds two FusedBatchNorm ops, training and inference, switched at run time.
+    """
+    # statistics and parameters stay float32 under a low precision policy
+    dtype = inputT.dtype
+    inputT = tf.cast(inputT, tf.float32)
+    outputT = tf.contrib.layers.batch_norm(inputT, is_training=is_training, center=False, fused=True,
+                                           decay=FLAGS.moving_average_decay, scope=scope)
+    return tf.cast(outputT, dtype)
+
+
+_BN_OPS = ('FusedBatchNorm', 'FusedBatchNormV2', 'FusedBatchNormV3')
+
+
+def _const_node(name, value, device=''):
+    node = tf.NodeDef()
+    node.op = 'Const'
+    node.name = name
+    node.device = device
+    value = np.asarray(value, dtype=np.float32)
+    node.attr['dtype'].type = tf.float32.as_datatype_enum
+    node.attr['value'].tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+    return node
+
+
+def fold_batch_norms(graph_def, output_names):
+    """
+    Folds every inference batch norm of a frozen graph_def (variables turned
+    into constants) into the conv2d + bias_add in front of it
+        W' = W * s,   b' = (b - mean) * s + offset,   s = scale / sqrt(variance + epsilon)
+    the batch norm node is replaced by the bias_add, under the batch norm name.
+    Layers built with a float16 / bfloat16 precision policy are left as they are.
+    Returns the folded graph_def pruned to output_names.
+    """
+    nodes = dict((node.name, node) for node in graph_def.node)
+    n_consumers = {}
+    for node in graph_def.node:
+        for name in node.input:
+            name = name.lstrip('^').split(':')[0]
+            n_consumers[name] = n_consumers.get(name, 0) + 1
+
+    def node_of(name):
+        return nodes[name.lstrip('^').split(':')[0]]
+
+    def const_of(name):
+        node = node_of(name)
+        while node.op == 'Identity':
+            node = node_of(node.input[0])
+        if node.op != 'Const':
+            return None
+        return tensor_util.MakeNdarray(node.attr['value'].tensor)
+
+    folded = {}  # batch norm name -> conv name, W', b'
+    for bn in graph_def.node:
+        if bn.op not in _BN_OPS or bn.attr['is_training'].b:
+            continue
+        bias_add = node_of(bn.input[0])
+        if bias_add.op != 'BiasAdd' or n_consumers[bias_add.name] != 1:
+            continue
+        conv = node_of(bias_add.input[0])
+        if conv.op != 'Conv2D' or n_consumers[conv.name] != 1:
+            continue
+        values = [const_of(name) for name in [conv.input[1], bias_add.input[1]] + list(bn.input[1:5])]
+        if any(v is None for v in values):
+            continue
+        weights, biases, scale, offset, mean, variance = values
+        s = scale / np.sqrt(variance + bn.attr['epsilon'].f)
+        folded[bn.name] = (conv.name, weights * s, (biases - mean) * s + offset)
+
+    folded_conv = dict((conv_name, weights) for conv_name, weights, _ in folded.values())
+    out = tf.GraphDef()
+    out.versions.CopyFrom(graph_def.versions)
+    out.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.name in folded:
+            conv_name, _, biases = folded[node.name]
+            bias_add = out.node.add()
+            bias_add.CopyFrom(node_of(node.input[0]))
+            bias_add.name = node.name
+            del bias_add.input[:]
+            bias_add.input.extend([conv_name, node.name + '/folded_biases'])
+            out.node.extend([_const_node(node.name + '/folded_biases', biases, node.device)])
+        elif node.name in folded_conv:
+            conv = out.node.add()
+            conv.CopyFrom(node)
+            conv.input[1] = node.name + '/folded_weights'
+            out.node.extend([_const_node(node.name + '/folded_weights', folded_conv[node.name], node.device)])
+        else:
+            out.node.extend([node])
+
+    print('Folded {} batch norms'.format(len(folded)))
+    return tf.graph_util.extract_sub_graph(out, output_names)
 
 
 def _variable_with_weight_decay(name, shape, initializer, wd):
@@ -111,8 +347,8 @@ def _variable_on_cpu(name, shape, initializer):
         Variable Tensor
     """
     with tf.device('/cpu:0'):
-        # dtype = tf.float16 if FLAGS.use_fp16 else tf.float32 #added this after, cause it was in cifar model
-        var = tf.get_variable(name, shape, initializer=initializer)  # , dtype=dtype)
+        # float32 whatever FLAGS.precision is, layers cast to activation_dtype()
+        var = tf.get_variable(name, shape, initializer=initializer)
     return var
 
 
@@ -126,220 +362,122 @@ def _variable_on_cpu(name, shape, initializer):
 # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 
-def inference_basic(images, is_training):
+# conv layer of a model spec
+CONV_LAYERS = {'dense': conv_layer_with_bn,
+               'separable': separable_conv_layer_with_bn,
+               'factorized': factorized_conv_layer_with_bn}
+
+MODEL_DEFAULTS = dict(stages=(1, 1, 1, 1), channels=64, kernel_size=7,
+                      dropout=False, input_lrn=False, conv='dense', chain_decoder=True,
+                      final_pool_dropout=True, decoder_dropout_name='dropout{}_decode')
+
+# FLAGS.model : the four original models and their cheaper convolution variants
+MODEL_PRESETS = {
+    'basic': dict(stages=(1, 1, 1, 1), input_lrn=True),
+    # the dropout layers (and their names) of the original dropout models
+    'basic_dropout': dict(stages=(1, 1, 1, 1), input_lrn=True, dropout=True,
+                          final_pool_dropout=False, decoder_dropout_name='decoder_dropout{}'),
+    'basic_separable': dict(stages=(1, 1, 1, 1), input_lrn=True, conv='separable'),
+    'basic_factorized': dict(stages=(1, 1, 1, 1), input_lrn=True, conv='factorized'),
+    # the original extended models unpool every pool output directly, not the
+    # decoder below : trained checkpoints only predict right with that graph
+    'extended': dict(stages=(2, 2, 3, 3, 3), chain_decoder=False),
+    'extended_dropout': dict(stages=(2, 2, 3, 3, 3), dropout=True,
+                             decoder_dropout_name=('dropout1_deconv', 'dropout2_decode',
+                                                   'dropout3_decode', 'dropout4_decode')),
+    'extended_separable': dict(stages=(2, 2, 3, 3, 3), conv='separable', chain_decoder=False),
+    'extended_factorized': dict(stages=(2, 2, 3, 3, 3), conv='factorized', chain_decoder=False),
+}
+
+
+def model_spec(model, **overrides):
     """
-      Args:
-        images: Images Tensors (placeholder with correct shape, img_h, img_w, img_d)
-        is_training: If the model is training or testing
+    MODEL_DEFAULTS < MODEL_PRESETS[model] < every override that is not None
     """
-    initializer = get_weight_initializer()
-    img_d = images.get_shape().as_list()[3]
-    norm1 = tf.nn.lrn(images, depth_radius=5, bias=1.0, alpha=0.0001, beta=0.75,
-                      name='norm1')
-    conv1 = conv_layer_with_bn(initializer, norm1, [7, 7, img_d, 64], is_training, name="conv1")
-    pool1, pool1_indices = tf.nn.max_pool_with_argmax(conv1, ksize=[1, 2, 2, 1],
-                                                      strides=[1, 2, 2, 1], padding='SAME', name='pool1')
-
-    conv2 = conv_layer_with_bn(initializer, pool1, [7, 7, 64, 64], is_training, name="conv2")
-    pool2, pool2_indices = tf.nn.max_pool_with_argmax(conv2, ksize=[1, 2, 2, 1],
-                                                      strides=[1, 2, 2, 1], padding='SAME', name='pool2')
-
-    conv3 = conv_layer_with_bn(initializer, pool2, [7, 7, 64, 64], is_training, name="conv3")
-    pool3, pool3_indices = tf.nn.max_pool_with_argmax(conv3, ksize=[1, 2, 2, 1],
-                                                      strides=[1, 2, 2, 1], padding='SAME', name='pool3')
-
-    conv4 = conv_layer_with_bn(initializer, pool3, [7, 7, 64, 64], is_training, name="conv4")
-    pool4, pool4_indices = tf.nn.max_pool_with_argmax(conv4, ksize=[1, 2, 2, 1],
-                                                      strides=[1, 2, 2, 1], padding='SAME', name='pool4')
-
-    """  End of encoder - starting decoder """
-
-    unpool_4 = unpool_with_argmax(pool4, ind=pool4_indices, name='unpool_4')
-    conv_decode4 = conv_layer_with_bn(initializer, unpool_4, [7, 7, 64, 64], is_training, False, name="conv_decode4")
-
-    unpool_3 = unpool_with_argmax(conv_decode4, ind=pool3_indices, name='unpool_3')
-    conv_decode3 = conv_layer_with_bn(initializer, unpool_3, [7, 7, 64, 64], is_training, False, name="conv_decode3")
-
-    unpool_2 = unpool_with_argmax(conv_decode3, ind=pool2_indices, name='unpool_2')
-    conv_decode2 = conv_layer_with_bn(initializer, unpool_2, [7, 7, 64, 64], is_training, False, name="conv_decode2")
-
-    unpool_1 = unpool_with_argmax(conv_decode2, ind=pool1_indices, name='unpool_1')
-    conv_decode1 = conv_layer_with_bn(initializer, unpool_1, [7, 7, 64, 64], is_training, False, name="conv_decode1")
-
-    return conv_classifier(conv_decode1, initializer)
-
-
-def inference_basic_dropout(images, is_training, keep_prob):
+    if model not in MODEL_PRESETS:
+        raise ValueError("The selected model does not exist")
+    spec = dict(MODEL_DEFAULTS)
+    spec.update(MODEL_PRESETS[model])
+    spec.update((k, v) for k, v in overrides.items() if v is not None)
+    return spec
+
+
+def inference_segnet(images, is_training, keep_prob=None, stages=(1, 1, 1, 1), channels=64,
+                     kernel_size=7, dropout=False, input_lrn=False, conv='dense',
+                     chain_decoder=True, final_pool_dropout=True,
+                     decoder_dropout_name='dropout{}_decode'):
     """
+      SegNet style encoder / decoder, every model of MODEL_PRESETS is one of these.
       Args:
         images: Images Tensors (placeholder with correct shape, img_h, img_w, img_d)
         is_training: If the model is training or testing
-        keep_prob = probability that the layer will be dropped (dropout layer active)
+        keep_prob = probability that the layer will be kept (dropout models only)
+        stages: conv layers per encoder stage, every stage ends with a 2x2 max pool.
+                The decoder mirrors it, every stage starts with an unpool
+        channels: output channels of the conv layers, an int or one per stage
+        kernel_size: size of the (square) conv kernels
+        dropout: dropout after every pool and before every unpool but the first
+        final_pool_dropout: False leaves out the dropout after the last pool
+        decoder_dropout_name: name of the dropout before the unpool of stage n,
+                a format string of n or one name per stage
+        input_lrn: local response normalization of the input
+        conv: 'dense', 'separable' or 'factorized', see CONV_LAYERS
+        chain_decoder: every decoder stage unpools the output of the one below.
+                False unpools the pool output of the matching encoder stage
+                instead, only the first decoder stage reaches the classifier
     """
     initializer = get_weight_initializer()
-    img_d = images.get_shape().as_list()[3]
-    norm1 = tf.nn.lrn(images, depth_radius=5, bias=1.0, alpha=0.0001, beta=0.75, name='norm1')
-
-    conv1 = conv_layer_with_bn(initializer, norm1, [7, 7, img_d, 64], is_training, name="conv1")
-    pool1, pool1_indices = tf.nn.max_pool_with_argmax(conv1, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool1')
-    dropout1 = tf.layers.dropout(pool1, rate=(1 - keep_prob), training=is_training, name="dropout1")
-
-    conv2 = conv_layer_with_bn(initializer, dropout1, [7, 7, 64, 64], is_training, name="conv2")
-    pool2, pool2_indices = tf.nn.max_pool_with_argmax(conv2, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool2')
-    dropout2 = tf.layers.dropout(pool2, rate=(1 - keep_prob), training=is_training, name="dropout2")
-
-    conv3 = conv_layer_with_bn(initializer, dropout2, [7, 7, 64, 64], is_training, name="conv3")
-    pool3, pool3_indices = tf.nn.max_pool_with_argmax(conv3, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool3')
-    dropout3 = tf.layers.dropout(pool3, rate=(1 - keep_prob), training=is_training, name="dropout3")
-
-    conv4 = conv_layer_with_bn(initializer, dropout3, [7, 7, 64, 64], is_training, name="conv4")
-    pool4, pool4_indices = tf.nn.max_pool_with_argmax(conv4, ksize=[1, 2, 2, 1],
-                                                      strides=[1, 2, 2, 1], padding='SAME', name='pool4')
+    conv_layer = CONV_LAYERS[conv]
+    if isinstance(channels, int):
+        channels = [channels] * len(stages)
+
+    def layer_name(prefix, stage, n):
+        # the names of the original models, so their checkpoints still restore
+        if max(stages) == 1:
+            return '{}{}'.format(prefix, stage)
+        return '{}{}_{}'.format(prefix, stage, n)
+
+    net = images
+    if input_lrn:
+        net = tf.nn.lrn(net, depth_radius=5, bias=1.0, alpha=0.0001, beta=0.75, name='norm1')
+    net = tf.cast(net, activation_dtype())
+    if dropout:
+        keep_prob = tf.cast(keep_prob, activation_dtype())
+
+    pooled = []
+    in_channel = net.get_shape().as_list()[3]
+    for s, n_convs in enumerate(stages):
+        for n in range(n_convs):
+            net = conv_layer(initializer, net, [kernel_size, kernel_size, in_channel, channels[s]],
+                             is_training, name=layer_name('conv', s + 1, n + 1))
+            in_channel = channels[s]
+        like = net
+        net, indices = max_pool(net, name='pool{}'.format(s + 1))
+        pooled.append((like, indices, net))
+        if dropout and (final_pool_dropout or s != len(stages) - 1):
+            net = tf.layers.dropout(net, rate=(1 - keep_prob), training=is_training,
+                                    name='dropout{}'.format(s + 1))
 
     """  End of encoder - starting decoder """
 
-    unpool_4 = unpool_with_argmax(pool4, ind=pool4_indices, name='unpool_4')
-    conv_decode4 = conv_layer_with_bn(initializer, unpool_4, [7, 7, 64, 64], is_training, False, name="conv_decode4")
-
-    decode_dropout3 = tf.layers.dropout(conv_decode4, rate=(1 - keep_prob), training=is_training, name="decoder_dropout3")
-    unpool_3 = unpool_with_argmax(decode_dropout3, ind=pool3_indices, name='unpool_3')
-    conv_decode3 = conv_layer_with_bn(initializer, unpool_3, [7, 7, 64, 64], is_training, False, name="conv_decode3")
-
-    decode_dropout2 = tf.layers.dropout(conv_decode3, rate=(1 - keep_prob), training=is_training, name="decoder_dropout2")
-    unpool_2 = unpool_with_argmax(decode_dropout2, ind=pool2_indices, name='unpool_2')
-    conv_decode2 = conv_layer_with_bn(initializer, unpool_2, [7, 7, 64, 64], is_training, False, name="conv_decode2")
-
-    decode_dropout1 = tf.layers.dropout(conv_decode2, rate=(1 - keep_prob), training=is_training, name="decoder_dropout1")
-    unpool_1 = unpool_with_argmax(decode_dropout1, ind=pool1_indices, name='unpool_1')
-    conv_decode1 = conv_layer_with_bn(initializer, unpool_1, [7, 7, 64, 64], is_training, False, name="conv_decode1")
-
-    return conv_classifier(conv_decode1, initializer)
-
-
-def inference_extended(images, is_training):
-    initializer = get_weight_initializer()
-    img_d = images.get_shape().as_list()[3]
-    conv1_1 = conv_layer_with_bn(initializer, images, [7, 7, img_d, 64], is_training, name="conv1_1")
-    conv1_2 = conv_layer_with_bn(initializer, conv1_1, [7, 7, 64, 64], is_training, name="conv1_2")
-    pool1, pool1_indices = tf.nn.max_pool_with_argmax(conv1_2, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool1')
-
-    conv2_1 = conv_layer_with_bn(initializer, pool1, [7, 7, 64, 64], is_training, name="conv2_1")
-    conv2_2 = conv_layer_with_bn(initializer, conv2_1, [7, 7, 64, 64], is_training, name="conv2_2")
-    pool2, pool2_indices = tf.nn.max_pool_with_argmax(conv2_2, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool2')
-
-    conv3_1 = conv_layer_with_bn(initializer, pool2, [7, 7, 64, 64], is_training, name="conv3_1")
-    conv3_2 = conv_layer_with_bn(initializer, conv3_1, [7, 7, 64, 64], is_training, name="conv3_2")
-    conv3_3 = conv_layer_with_bn(initializer, conv3_2, [7, 7, 64, 64], is_training, name="conv3_3")
-    pool3, pool3_indices = tf.nn.max_pool_with_argmax(conv3_3, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool3')
-
-    conv4_1 = conv_layer_with_bn(initializer, pool3, [7, 7, 64, 64], is_training, name="conv4_1")
-    conv4_2 = conv_layer_with_bn(initializer, conv4_1, [7, 7, 64, 64], is_training, name="conv4_2")
-    conv4_3 = conv_layer_with_bn(initializer, conv4_2, [7, 7, 64, 64], is_training, name="conv4_3")
-    pool4, pool4_indices = tf.nn.max_pool_with_argmax(conv4_3, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool4')
-
-    conv5_1 = conv_layer_with_bn(initializer, pool4, [7, 7, 64, 64], is_training, name="conv5_1")
-    conv5_2 = conv_layer_with_bn(initializer, conv5_1, [7, 7, 64, 64], is_training, name="conv5_2")
-    conv5_3 = conv_layer_with_bn(initializer, conv5_2, [7, 7, 64, 64], is_training, name="conv5_3")
-    pool5, pool5_indices = tf.nn.max_pool_with_argmax(conv5_3, ksize=[1, 2, 2, 1],
-                                                      strides=[1, 2, 2, 1], padding='SAME', name='pool5')
-    """ End of encoder """
-
-    """ Start decoder """
-    unpool_5 = unpool_with_argmax(pool5, ind=pool5_indices, name="unpool_5")
-    conv_decode5_1 = conv_layer_with_bn(initializer, unpool_5, [7, 7, 64, 64], is_training, False, name="conv_decode5_1")
-    conv_decode5_2 = conv_layer_with_bn(initializer, conv_decode5_1, [7, 7, 64, 64], is_training, False, name="conv_decode5_2")
-    conv_decode5_3 = conv_layer_with_bn(initializer, conv_decode5_2, [7, 7, 64, 64], is_training, False, name="conv_decode5_3")
-
-    unpool_4 = unpool_with_argmax(pool4, ind=pool4_indices, name="unpool_4")
-    conv_decode4_1 = conv_layer_with_bn(initializer, unpool_4, [7, 7, 64, 64], is_training, False, name="conv_decode4_1")
-    conv_decode4_2 = conv_layer_with_bn(initializer, conv_decode4_1, [7, 7, 64, 64], is_training, False, name="conv_decode4_2")
-    conv_decode4_3 = conv_layer_with_bn(initializer, conv_decode4_2, [7, 7, 64, 64], is_training, False, name="conv_decode4_3")
-
-    unpool_3 = unpool_with_argmax(pool3, ind=pool3_indices, name="unpool_3")
-    conv_decode3_1 = conv_layer_with_bn(initializer, unpool_3, [7, 7, 64, 64], is_training, False, name="conv_decode3_1")
-    conv_decode3_2 = conv_layer_with_bn(initializer, conv_decode3_1, [7, 7, 64, 64], is_training, False, name="conv_decode3_2")
-    conv_decode3_3 = conv_layer_with_bn(initializer, conv_decode3_2, [7, 7, 64, 64], is_training, False, name="conv_decode3_3")
-
-    unpool_2 = unpool_with_argmax(pool2, ind=pool2_indices, name="unpool_2")
-    conv_decode2_1 = conv_layer_with_bn(initializer, unpool_2, [7, 7, 64, 64], is_training, False, name="conv_decode2_1")
-    conv_decode2_2 = conv_layer_with_bn(initializer, conv_decode2_1, [7, 7, 64, 64], is_training, False, name="conv_decode2_2")
-
-    unpool_1 = unpool_with_argmax(pool1, ind=pool1_indices, name="unpool_1")
-    conv_decode1_1 = conv_layer_with_bn(initializer, unpool_1, [7, 7, 64, 64], is_training, False, name="conv_decode1_1")
-    conv_decode1_2 = conv_layer_with_bn(initializer, conv_decode1_1, [7, 7, 64, 64], is_training, False, name="conv_decode1_2")
-    """ End of decoder """
-
-    return conv_classifier(conv_decode1_2, initializer)
-
-
-def inference_extended_dropout(images, is_training, keep_prob):
-    """
-      Args:
-        images: Images Tensors (placeholder with correct shape, img_h, img_w, img_d)
-        is_training: If the model is training or testing
-        keep_prob = probability that the layer will be dropped (dropout layer active)
-    """
-
-    initializer = get_weight_initializer()
-    conv1_1 = conv_layer_with_bn(initializer, images, [7, 7, images.get_shape().as_list()[3], 64], is_training, name="conv1_1")
-    conv1_2 = conv_layer_with_bn(initializer, conv1_1, [7, 7, 64, 64], is_training, name="conv1_2")
-    pool1, pool1_indices = tf.nn.max_pool_with_argmax(conv1_2, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool1')
-    dropout1 = tf.layers.dropout(pool1, rate=(1 - keep_prob), training=is_training, name="dropout1")
-
-    conv2_1 = conv_layer_with_bn(initializer, dropout1, [7, 7, 64, 64], is_training, name="conv2_1")
-    conv2_2 = conv_layer_with_bn(initializer, conv2_1, [7, 7, 64, 64], is_training, name="conv2_2")
-    pool2, pool2_indices = tf.nn.max_pool_with_argmax(conv2_2, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool2')
-    dropout2 = tf.layers.dropout(pool2, rate=(1 - keep_prob), training=is_training, name="dropout2")
-
-    conv3_1 = conv_layer_with_bn(initializer, dropout2, [7, 7, 64, 64], is_training, name="conv3_1")
-    conv3_2 = conv_layer_with_bn(initializer, conv3_1, [7, 7, 64, 64], is_training, name="conv3_2")
-    conv3_3 = conv_layer_with_bn(initializer, conv3_2, [7, 7, 64, 64], is_training, name="conv3_3")
-    pool3, pool3_indices = tf.nn.max_pool_with_argmax(conv3_3, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool3')
-    dropout3 = tf.layers.dropout(pool3, rate=(1 - keep_prob), training=is_training, name="dropout3")
-
-    conv4_1 = conv_layer_with_bn(initializer, dropout3, [7, 7, 64, 64], is_training, name="conv4_1")
-    conv4_2 = conv_layer_with_bn(initializer, conv4_1, [7, 7, 64, 64], is_training, name="conv4_2")
-    conv4_3 = conv_layer_with_bn(initializer, conv4_2, [7, 7, 64, 64], is_training, name="conv4_3")
-    pool4, pool4_indices = tf.nn.max_pool_with_argmax(conv4_3, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool4')
-    dropout4 = tf.layers.dropout(pool4, rate=(1 - keep_prob), training=is_training, name="dropout4")
-
-    conv5_1 = conv_layer_with_bn(initializer, dropout4, [7, 7, 64, 64], is_training, name="conv5_1")
-    conv5_2 = conv_layer_with_bn(initializer, conv5_1, [7, 7, 64, 64], is_training, name="conv5_2")
-    conv5_3 = conv_layer_with_bn(initializer, conv5_2, [7, 7, 64, 64], is_training, name="conv5_3")
-    pool5, pool5_indices = tf.nn.max_pool_with_argmax(conv5_3, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME', name='pool5')
-    dropout5 = tf.layers.dropout(pool5, rate=(1 - keep_prob), training=is_training, name="dropout5")
-    """ End of encoder """
-
-    """ Start decoder """
-    unpool_5 = unpool_with_argmax(dropout5, ind=pool5_indices, name='unpool_5')
-    conv_decode5_1 = conv_layer_with_bn(initializer, unpool_5, [7, 7, 64, 64], is_training, False, name="conv_decode5_1")
-    conv_decode5_2 = conv_layer_with_bn(initializer, conv_decode5_1, [7, 7, 64, 64], is_training, False, name="conv_decode5_2")
-    conv_decode5_3 = conv_layer_with_bn(initializer, conv_decode5_2, [7, 7, 64, 64], is_training, False, name="conv_decode5_3")
-
-    dropout4_decode = tf.layers.dropout(conv_decode5_3, rate=(1 - keep_prob), training=is_training, name="dropout4_decode")
-    unpool_4 = unpool_with_argmax(dropout4_decode, ind=pool4_indices, name='unpool_4')
-    conv_decode4_1 = conv_layer_with_bn(initializer, unpool_4, [7, 7, 64, 64], is_training, False, name="conv_decode4_1")
-    conv_decode4_2 = conv_layer_with_bn(initializer, conv_decode4_1, [7, 7, 64, 64], is_training, False, name="conv_decode4_2")
-    conv_decode4_3 = conv_layer_with_bn(initializer, conv_decode4_2, [7, 7, 64, 64], is_training, False, name="conv_decode4_3")
-
-    dropout3_decode = tf.layers.dropout(conv_decode4_3, rate=(1 - keep_prob), training=is_training, name="dropout3_decode")
-    unpool_3 = unpool_with_argmax(dropout3_decode, ind=pool3_indices, name='unpool_3')
-    conv_decode3_1 = conv_layer_with_bn(initializer, unpool_3, [7, 7, 64, 64], is_training, False, name="conv_decode3_1")
-    conv_decode3_2 = conv_layer_with_bn(initializer, conv_decode3_1, [7, 7, 64, 64], is_training, False, name="conv_decode3_2")
-    conv_decode3_3 = conv_layer_with_bn(initializer, conv_decode3_2, [7, 7, 64, 64], is_training, False, name="conv_decode3_3")
-
-    dropout2_decode = tf.layers.dropout(conv_decode3_3, rate=(1 - keep_prob), training=is_training, name="dropout2_decode")
-    unpool_2 = unpool_with_argmax(dropout2_decode, ind=pool2_indices, name='unpool_2')
-    conv_decode2_1 = conv_layer_with_bn(initializer, unpool_2, [7, 7, 64, 64], is_training, False, name="conv_decode2_1")
-    conv_decode2_2 = conv_layer_with_bn(initializer, conv_decode2_1, [7, 7, 64, 64], is_training, False, name="conv_decode2_2")
-
-    dropout1_decode = tf.layers.dropout(conv_decode2_2, rate=(1 - keep_prob), training=is_training, name="dropout1_deconv")
-    unpool_1 = unpool_with_argmax(dropout1_decode, ind=pool1_indices, name='unpool_1')
-    conv_decode1_1 = conv_layer_with_bn(initializer, unpool_1, [7, 7, 64, 64], is_training, False, name="conv_decode1_1")
-    conv_decode1_2 = conv_layer_with_bn(initializer, conv_decode1_1, [7, 7, 64, 64], is_training, False, name="conv_decode1_2")
-    """ End of decoder """
-
-    return conv_classifier(conv_decode1_2, initializer)
+    for s in reversed(range(len(stages))):
+        like, indices, pool = pooled[s]
+        if not chain_decoder:
+            net = pool
+        if dropout and s != len(stages) - 1:
+            if isinstance(decoder_dropout_name, str):
+                name = decoder_dropout_name.format(s + 1)
+            else:
+                name = decoder_dropout_name[s]
+            net = tf.layers.dropout(net, rate=(1 - keep_prob), training=is_training, name=name)
+        net = unpool(net, ind=indices, like=like, name='unpool_{}'.format(s + 1))
+        # the last conv of a stage maps to the channels of the stage below
+        for n in range(stages[s]):
+            out_channel = channels[s] if n < stages[s] - 1 else channels[max(s - 1, 0)]
+            net = conv_layer(initializer, net, [kernel_size, kernel_size, channels[s], out_channel],
+                             is_training, False, name=layer_name('conv_decode', s + 1, n + 1))
+
+    return conv_classifier(net, initializer)
 
 
 def get_weight_initializer():
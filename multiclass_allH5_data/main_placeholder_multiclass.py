@@ -1,4 +1,3 @@
-import os
 import tensorflow as tf
 import time
 from datetime import datetime
@@ -7,6 +6,7 @@ import config
 import batch_inputs
 import evaluation
 import training
+import checkpoint_manager
 import inference_gray
 inference = inference_gray
 
@@ -16,61 +16,84 @@ IMAGE_SIZE = 176
 FLAGS = tf.app.flags.FLAGS
 
 
+def build_model(images, is_training, keep_prob, model=None):
+    # model : an inference.MODEL_PRESETS name, FLAGS.model when None.
+    # --model_stages / --model_channels / --model_kernel_size override the preset
+    spec = inference.model_spec(FLAGS.model if model is None else model,
+                                stages=[int(n) for n in FLAGS.model_stages.split(',')]
+                                if FLAGS.model_stages else None,
+                                channels=FLAGS.model_channels or None,
+                                kernel_size=FLAGS.model_kernel_size or None)
+    return inference.inference_segnet(images, is_training, keep_prob, **spec)
+
+
 def train(is_finetune=False):
 
     tf.reset_default_graph()
+    input_fn = batch_inputs.dataset_inputs if FLAGS.use_tf_data else batch_inputs.inputs
     startstep = 0 if not is_finetune else int(FLAGS.finetune_dir.split('-')[-1])
     with tf.Graph().as_default():
         # ++++++++++++++++++++++++ TRAINING INPUT LAODING ++++++++++++++++++++++++
-        x_train, y_train, id_train = batch_inputs.inputs(['./record/train.tfrecords'],
-                                                         FLAGS.batch_size, False)
-        # print(x_train.shape)
-        y_train = tf.one_hot(y_train, FLAGS.num_class)
-        # print(y_train.shape)
+        x_train, y_train, id_train = input_fn(batch_inputs.record_files('train'),
+                                              FLAGS.batch_size, False)
         tf.summary.image('images', x_train)
-        x_train = tf.image.resize_image_with_crop_or_pad(x_train, IMAGE_SIZE,
-                                                         IMAGE_SIZE)
-        y_train = tf.image.resize_image_with_crop_or_pad(y_train, IMAGE_SIZE,
-                                                         IMAGE_SIZE)
+        x_train, y_train = batch_inputs.crop_batch(x_train, y_train, IMAGE_SIZE,
+                                                   FLAGS.sparse_labels)
         # ++++++++++++++++++++++++ TESTING INPUT LAODING ++++++++++++++++++++++++
-        x_test, y_test, id_test = batch_inputs.inputs(['./record/test.tfrecords'],
-                                                      FLAGS.batch_size, True)
-        y_test = tf.one_hot(y_test, FLAGS.num_class)
-        tf.summary.image('images', x_test)
-        x_test = tf.image.resize_image_with_crop_or_pad(x_test, IMAGE_SIZE,
-                                                        IMAGE_SIZE)
-        y_test = tf.image.resize_image_with_crop_or_pad(y_test, IMAGE_SIZE,
-                                                        IMAGE_SIZE)
+        # without inline validation the checkpoints are evaluated by evaluator.py
+        if FLAGS.inline_validation:
+            x_test, y_test, id_test = input_fn(batch_inputs.record_files('test'),
+                                               FLAGS.batch_size, True)
+            tf.summary.image('images', x_test)
+            x_test, y_test = batch_inputs.crop_batch(x_test, y_test, IMAGE_SIZE,
+                                                     FLAGS.sparse_labels)
         # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-        is_training = tf.placeholder(tf.bool, name='is_training')
+        # a python bool builds the training batch norms only, a tensor
+        # switches them to the frozen statistics for inline validation
+        if FLAGS.inline_validation:
+            is_training = tf.placeholder(tf.bool, name='is_training')
+        else:
+            is_training = True
         keep_prob = tf.placeholder(tf.float32, name="keep_probabilty")
-        images = tf.placeholder(tf.float32,
-                                shape=[None,
-                                       FLAGS.image_h, FLAGS.image_w, FLAGS.image_c])
-        labels = tf.placeholder(tf.int64,
-                                [None,
-                                 FLAGS.image_h, FLAGS.image_w, FLAGS.num_class])
+        # sparse labels are uint8 class maps, dense ones int64 one-hot
+        if FLAGS.sparse_labels:
+            label_dtype = tf.uint8
+            label_shape = [None, FLAGS.image_h, FLAGS.image_w]
+        else:
+            label_dtype = tf.int64
+            label_shape = [None, FLAGS.image_h, FLAGS.image_w, FLAGS.num_class]
+        if FLAGS.feed_inputs:
+            images = tf.placeholder(tf.float32,
+                                    shape=[None,
+                                           FLAGS.image_h, FLAGS.image_w, FLAGS.image_c])
+            labels = tf.placeholder(label_dtype, label_shape)
+        else:
+            # the training batch goes straight from the input pipeline into the
+            # model, feeding images / labels (validation) overrides it
+            images = tf.placeholder_with_default(x_train,
+                                                 shape=[None,
+                                                        FLAGS.image_h, FLAGS.image_w, FLAGS.image_c])
+            labels = tf.placeholder_with_default(tf.cast(y_train, label_dtype),
+                                                 shape=label_shape)
         # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
         print('++++++++ Mode building starts here +++++++++')
-        if FLAGS.model == "basic":
-            logits = inference.inference_basic(images, is_training)
-        elif FLAGS.model == "extended":
-            logits = inference.inference_extended(images, is_training)
-        elif FLAGS.model == "basic_dropout":
-            logits = inference.inference_basic_dropout(images, is_training, keep_prob)
-        elif FLAGS.model == "extended_dropout":
-            logits = inference.inference_extended_dropout(images, is_training, keep_prob)
-        else:
-            raise ValueError("The selected model does not exist")
+        logits = build_model(images, is_training, keep_prob)
 
-        loss = evaluation.loss_calc(logits=logits, labels=labels)
+        if FLAGS.sparse_labels:
+            loss = evaluation.sparse_loss_calc(logits=logits, labels=labels)
+            hist_op = evaluation.sparse_hist(logits=logits, labels=labels)
+        else:
+            loss = evaluation.loss_calc(logits=logits, labels=labels)
+            hist_op = evaluation.sparse_hist(logits=logits, labels=tf.argmax(labels, axis=3))
         train_op, global_step = training.training(loss=loss)
         accuracy = tf.argmax(logits, axis=3)
 
         summary = tf.summary.merge_all()
-        saver = tf.train.Saver(max_to_keep=1000)
+        # restores finetune_dir, checkpoints are written by the manager
+        saver = tf.train.Saver()
+        manager = checkpoint_manager.CheckpointManager(FLAGS.log_dir)
 
         with tf.Session() as sess:
 
@@ -80,6 +103,7 @@ def train(is_finetune=False):
                 print("\n    Batch size is: ", FLAGS.batch_size)
                 print("    ckpt files are saved to: ", FLAGS.log_dir)
                 print("    Max iterations to train is: ", config.n_train_steps)
+                print("    Inline validation: ", FLAGS.inline_validation)
                 print(" =====================================================")
                 saver.restore(sess, FLAGS.finetune_dir)
             else:
@@ -88,6 +112,7 @@ def train(is_finetune=False):
                 print("\n    Batch size is: ", FLAGS.batch_size)
                 print("    ckpt files are saved to: ", FLAGS.log_dir)
                 print("    Max iterations to train is: ", config.n_train_steps)
+                print("    Inline validation: ", FLAGS.inline_validation)
                 print(" =====================================================")
                 sess.run(tf.variables_initializer(tf.global_variables()))
                 sess.run(tf.local_variables_initializer())
@@ -97,73 +122,82 @@ def train(is_finetune=False):
 
             train_writer = tf.summary.FileWriter(FLAGS.log_dir, sess.graph)
 
-            for step in range(startstep + 1, startstep + config.n_train_steps + 1):
-                images_batch, labels_batch = sess.run(fetches=[x_train, y_train])
-
-                train_feed_dict = {images: images_batch,
-                                   labels: labels_batch,
-                                   is_training: True,
-                                   keep_prob: 0.5}
-
-                start_time = time.time()
-
-                _, train_loss_value, \
-                    train_accuracy_value, \
-                    train_summary_str = sess.run([train_op, loss, accuracy, summary], feed_dict=train_feed_dict)
-
-                # Finding duration for training batch
-                duration = time.time() - start_time
-
-                if step % 10 == 0:  # Print info about training
-                    examples_per_sec = FLAGS.batch_size / duration
-                    sec_per_batch = float(duration)
-
-                    print('\n--- Normal training ---')
-                    format_str = ('%s: step %d, loss = %.2f (%.1f examples/sec; %.3f '
-                                  'sec/batch)')
-                    print (format_str % (datetime.now(), step, train_loss_value,
-                                         examples_per_sec, sec_per_batch))
-
-                    # eval current training batch pre - class accuracy
-                    pred = sess.run(logits, feed_dict=train_feed_dict)
-                    # evaluation.per_class_acc(pred, labels_batch)  # printing class accuracy
-
-                    train_writer.add_summary(train_summary_str, step)
-                    train_writer.flush()
-
-                if step % 100 == 0 or (step + 1) == config.n_train_steps:
-                    # test_iter = FLAGS.num_examples_epoch_test // FLAGS.test_batch_size
-                    test_iter = FLAGS.num_examples_epoch_test // FLAGS.batch_size
-                    """ Validate training by running validation dataset """
-                    print("\n===========================================================")
-                    print("--- Running test on VALIDATION dataset ---")
-                    total_val_loss = 0.0
-                    # hist = np.zeros((FLAGS.num_class, FLAGS.num_class))
-                    for val_step in range(test_iter):
-                        test_img_batch, test_lbl_batch = sess.run(fetches=[x_test,
-                                                                           y_test])
-
-                        val_feed_dict = {images: test_img_batch,
-                                         labels: test_lbl_batch,
-                                         is_training: True,
-                                         keep_prob: 1.0}
-
-                        _val_loss, _val_pred = sess.run(fetches=[loss, logits],
-                                                        feed_dict=val_feed_dict)
-                        total_val_loss += _val_loss
-                        # hist += evaluation.get_hist(_val_pred, val_labels_batch)
-                    print("Validation Loss: ", total_val_loss / test_iter, ". If this value increases the model is likely overfitting.")
-                    # evaluation.print_hist_summery(hist)
-                    print("===========================================================")
-
-                # Save the model checkpoint periodically.
-                if step % 1000 == 0 or step % 200 == 0 \
-                        or (step + 1) == config.n_train_steps:
-                    print("\n--- SAVING SESSION ---")
-                    checkpoint_path = os.path.join(FLAGS.log_dir, 'model.ckpt')
-                    saver.save(sess, checkpoint_path, global_step=step)
-                    print("=========================")
-
+            # the last checkpoint is written out even when training is interrupted
+            try:
+                for step in range(startstep + 1, startstep + config.n_train_steps + 1):
+                    start_time = time.time()
+                    val_metrics = None
+
+                    train_feed_dict = {keep_prob: 0.5}
+                    if FLAGS.inline_validation:
+                        train_feed_dict[is_training] = True
+                    if FLAGS.feed_inputs:
+                        images_batch, labels_batch = sess.run(fetches=[x_train, y_train])
+                        train_feed_dict[images] = images_batch
+                        train_feed_dict[labels] = labels_batch
+
+                    _, train_loss_value, \
+                        train_accuracy_value, \
+                        train_summary_str = sess.run([train_op, loss, accuracy, summary], feed_dict=train_feed_dict)
+
+                    # Finding duration for training batch
+                    duration = time.time() - start_time
+
+                    if step % 10 == 0:  # Print info about training
+                        examples_per_sec = FLAGS.batch_size / duration
+                        sec_per_batch = float(duration)
+
+                        print('\n--- Normal training ---')
+                        format_str = ('%s: step %d, loss = %.2f (%.1f examples/sec; %.3f '
+                                      'sec/batch)')
+                        print (format_str % (datetime.now(), step, train_loss_value,
+                                             examples_per_sec, sec_per_batch))
+
+                        # eval current training batch pre - class accuracy
+                        # evaluation.per_class_acc(pred, labels_batch)  # printing class accuracy
+
+                        train_writer.add_summary(train_summary_str, step)
+                        train_writer.flush()
+
+                    if FLAGS.inline_validation and \
+                            (step % 100 == 0 or (step + 1) == config.n_train_steps):
+                        # test_iter = FLAGS.num_examples_epoch_test // FLAGS.test_batch_size
+                        test_iter = FLAGS.num_examples_epoch_test // FLAGS.batch_size
+                        """ Validate training by running validation dataset """
+                        print("\n===========================================================")
+                        print("--- Running test on VALIDATION dataset ---")
+                        total_val_loss = 0.0
+                        hist = np.zeros((FLAGS.num_class, FLAGS.num_class))
+                        for val_step in range(test_iter):
+                            test_img_batch, test_lbl_batch = sess.run(fetches=[x_test,
+                                                                               y_test])
+
+                            # frozen batch norm statistics, dropout off
+                            val_feed_dict = {images: test_img_batch,
+                                             labels: test_lbl_batch,
+                                             is_training: False,
+                                             keep_prob: 1.0}
+
+                            _val_loss, _val_hist = sess.run(fetches=[loss, hist_op],
+                                                            feed_dict=val_feed_dict)
+                            total_val_loss += _val_loss
+                            hist += _val_hist
+                        print("Validation Loss: ", total_val_loss / test_iter, ". If this value increases the model is likely overfitting.")
+                        evaluation.print_hist_summery(hist)
+                        val_metrics = evaluation.hist_metrics(hist)
+                        print("===========================================================")
+
+                    # Save the model checkpoint periodically.
+                    if step % 1000 == 0 or step % 200 == 0 \
+                            or (step + 1) == config.n_train_steps:
+                        print("\n--- SAVING SESSION ---")
+                        manager.save(sess, step, metrics=val_metrics)
+                        print("=========================")
+            finally:
+                manager.close()
+
+            for path, metric in manager.best():
+                print("  {} : {} = {:.4f}".format(path, config.CKPT_BEST_METRIC, metric))
             coord.request_stop()
             coord.join(threads)
 
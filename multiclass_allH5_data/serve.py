@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Local CPU segmentation service. Windows of concurrent requests are coalesced
+into dynamic batches (up to config.SERVE_MAX_BATCH, waiting at most
+config.SERVE_MAX_LATENCY_MS) and run by one session restored from the
+training checkpoints in --log_dir, or from --frozen_graph.
+
+    python serve.py --model=basic
+
+    POST /segment   body : .npy float32 (240, 240, 4) slice or (n, 240, 240, 4)
+                           slices / volume, raw modalities (flair, t1, t1ce, t2)
+                    reply : .npy uint8 (n, 240, 240) BraTS labels
+                    at most config.SERVE_MAX_SLICES slices, 411 / 413 without a
+                    Content-Length or above it
+    GET  /metrics   latency p50 / p99, batch fill, request / slice / batch counts (JSON)
+"""
+
+from __future__ import division, print_function, absolute_import
+import io
+import os
+import json
+import time
+import socket
+import threading
+import collections
+import numpy as np
+import tensorflow as tf
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, TCPServer
+    import Queue as queue
+except ImportError:  # python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, TCPServer
+    import queue
+
+import config
+from infer_volume import VolumeSegmenter, MODALITIES, SLICE_SIZE
+
+FLAGS = tf.app.flags.FLAGS
+
+N_LATENCIES = 1000
+# largest body accepted : SERVE_MAX_SLICES float64 slices and the .npy header
+MAX_BODY_BYTES = config.SERVE_MAX_SLICES * SLICE_SIZE * SLICE_SIZE * len(MODALITIES) * 8 + 4096
+
+
+class _Request(object):
+
+    def __init__(self, images):
+        self.images = images
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class DynamicBatcher(object):
+    '''
+    Runs run_batch on batches coalesced from the windows of every request
+    submitted while the previous batch ran, up to max_batch_size windows or
+    max_latency_ms after the first one. Requests with more windows than
+    max_batch_size are run in several batches.
+    '''
+
+    def __init__(self, run_batch, max_batch_size=config.SERVE_MAX_BATCH,
+                 max_latency_ms=config.SERVE_MAX_LATENCY_MS):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.n_batches = 0
+        self.n_windows = 0
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, images):
+        request = _Request(images)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def stats(self):
+        '''
+        returns the batches and windows run so far, read together, and the mean batch fill
+        '''
+        with self.lock:
+            n_batches, n_windows = self.n_batches, self.n_windows
+        fill = n_windows / (n_batches * self.max_batch_size) if n_batches else 0.0
+        return n_batches, n_windows, fill
+
+    def _collect(self):
+        pending = [self.queue.get()]
+        n_windows = len(pending[0].images)
+        deadline = time.time() + self.max_latency
+        while n_windows < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            pending.append(request)
+            n_windows += len(request.images)
+        return pending
+
+    def _loop(self):
+        while True:
+            pending = self._collect()
+            try:
+                images = np.concatenate([request.images for request in pending])
+                results = []
+                for start in range(0, len(images), self.max_batch_size):
+                    batch = images[start:start + self.max_batch_size]
+                    results.append(self.run_batch(batch))
+                    with self.lock:
+                        self.n_batches += 1
+                        self.n_windows += len(batch)
+                results = np.concatenate(results)
+                offset = 0
+                for request in pending:
+                    request.result = results[offset:offset + len(request.images)]
+                    offset += len(request.images)
+            except Exception as e:
+                for request in pending:
+                    request.error = e
+            for request in pending:
+                request.done.set()
+
+
+class BatchedSegmenter(VolumeSegmenter):
+    '''
+    VolumeSegmenter whose windows go through a DynamicBatcher shared by all
+    request threads, instead of straight into the session
+    '''
+
+    def __init__(self, **kwargs):
+        # a request hands its windows to the batcher one full batch at a time,
+        # only one batch of them is stacked in memory per request
+        VolumeSegmenter.__init__(self, batch_size=config.SERVE_MAX_BATCH, **kwargs)
+        self.batcher = DynamicBatcher(lambda images: VolumeSegmenter.predict(self, images))
+
+    def predict(self, images):
+        return self.batcher.submit(images)
+
+
+class SegmentHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if self.path != '/segment':
+            self.send_error(404)
+            return
+        start_time = time.time()
+        # the body is only read once its size is known and bounded
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self.send_error(411)
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400, 'invalid Content-Length')
+            return
+        if length > MAX_BODY_BYTES:
+            self.send_error(413, 'at most {} slices per request'.format(config.SERVE_MAX_SLICES))
+            return
+        try:
+            body = self.rfile.read(length)
+            # a pickled body would run code in the server
+            volume = np.load(io.BytesIO(body), allow_pickle=False)
+            if volume.ndim == 3:
+                volume = volume[np.newaxis]
+            if volume.ndim != 4 or volume.shape[1:] != (SLICE_SIZE, SLICE_SIZE, len(MODALITIES)):
+                raise ValueError('expected (240, 240, 4) or (n, 240, 240, 4) slices, '
+                                 'got {}'.format(volume.shape))
+            volume = volume.astype(np.float32)
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+        if len(volume) > config.SERVE_MAX_SLICES:
+            self.send_error(413, 'at most {} slices per request'.format(config.SERVE_MAX_SLICES))
+            return
+        try:
+            labels = self.server.segmenter.segment_volume(volume)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        reply = io.BytesIO()
+        np.save(reply, labels)
+        self._send(reply.getvalue(), 'application/octet-stream')
+        self.server.record(time.time() - start_time, len(volume))
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        self._send(json.dumps(self.server.metrics()).encode('utf-8'), 'application/json')
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SegmentServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, segmenter):
+        HTTPServer.__init__(self, address, SegmentHandler)
+        self.segmenter = segmenter
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=N_LATENCIES)
+        self.n_requests = 0
+        self.n_slices = 0
+
+    def record(self, latency, n_slices):
+        with self.lock:
+            self.latencies.append(latency)
+            self.n_requests += 1
+            self.n_slices += n_slices
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            n_requests, n_slices = self.n_requests, self.n_slices
+        n_batches, n_windows, fill = self.segmenter.batcher.stats()
+        p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) else (0.0, 0.0)
+        return {'requests': n_requests,
+                'slices': n_slices,
+                'latency_ms_p50': 1000 * p50,
+                'latency_ms_p99': 1000 * p99,
+                'batches': n_batches,
+                'windows': n_windows,
+                'batch_fill': fill}
+
+
+class UnixSegmentServer(SegmentServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a (host, port) address
+        TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = TCPServer.get_request(self)
+        return request, ('local', 0)
+
+
+def main(args):
+    session_config = tf.ConfigProto(device_count={'GPU': 0},
+                                    intra_op_parallelism_threads=config.SERVE_THREADS or 0,
+                                    inter_op_parallelism_threads=1)
+    segmenter = BatchedSegmenter(frozen_graph=FLAGS.frozen_graph, session_config=session_config)
+
+    if config.SERVE_SOCKET:
+        if os.path.exists(config.SERVE_SOCKET):
+            os.remove(config.SERVE_SOCKET)
+        server = UnixSegmentServer(config.SERVE_SOCKET, segmenter)
+        print('Serving on ', config.SERVE_SOCKET)
+    else:
+        server = SegmentServer((config.SERVE_HOST, config.SERVE_PORT), segmenter)
+        print('Serving on {}:{}'.format(config.SERVE_HOST, config.SERVE_PORT))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    segmenter.close()
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -2,17 +2,33 @@
 
 import numpy as np
 import random
+import sys
+import time
+import itertools
+import traceback
+import multiprocessing
 from glob import glob
 from skimage import io
 import os
 
 import config
+import split_manifest
+import h5_store
 import h5py
 
 
 np.random.seed(5)  # for reproducibility
 
 
+def _makedirs(path):
+    # pool workers race on creating the shared destination dirs
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
 class BrainPipeline(object):
     '''
     A class for processing brain scans for one patient
@@ -20,26 +36,31 @@ class BrainPipeline(object):
             flair, t1, t1c, t2, ground truth (gt)
             (2) bool 'n4itk': True to use n4itk normed t1 scans (defaults to True)
             (3) bool 'n4itk_apply': True to apply and save n4itk filter to t1 and t1c scans for given patient. This will only work if the
+            (4) bool 'brain_mask': True to compute normalization statistics over brain pixels only
+            (5) tuple 'clip_pct': (low, high) percentiles to clip each slice to before normalizing, None to disable
     '''
 
-    def __init__(self, path, n4itk=True, n4itk_apply=False):
+    def __init__(self, path, n4itk=True, n4itk_apply=False,
+                 brain_mask=config.NORM_BRAIN_MASK, clip_pct=config.NORM_CLIP_PCT):
         self.path = path
+        self.brain_mask = brain_mask
+        self.clip_pct = clip_pct
         # self.n4itk = n4itk
         # self.n4itk_apply = n4itk_apply
         self.modes = ['flair', 't1', 't1c', 't2', 'gt']
-        _, self.slices_by_slice = self.read_scans()
-        self.normed_slices = self.norm_slices()
+        self.slices_by_mode, self.slices_by_slice, self.gt = self.read_scans()
+        self._normed_slices = None
         print(self.slices_by_slice.shape)
-        print(self.normed_slices.shape)
 
     def read_scans(self):
         '''
         goes into each modality in patient directory and loads individual scans.
-        transforms scans of same slice into strip of 5 images
+        modalities are stored once in a float32 (4, 155, 240, 240) volume and
+        the gt in a uint8 (155, 240, 240) mask. slices_by_slice is the
+        transposed (155, 4, 240, 240) view of that volume, no copy is made
         '''
         print 'Loading scans...'
-        slices_by_mode = np.zeros((5, 155, 240, 240))
-        slices_by_slice = np.zeros((155, 5, 240, 240))
+        slices_by_mode = np.empty((4, 155, 240, 240), dtype=np.float32)
 
         flair = glob(self.path + '*_flair.nii.gz')
         print flair
@@ -60,42 +81,83 @@ class BrainPipeline(object):
         # elif self.n4itk:
         #     scans = [flair[0], t1[0], t1c[0], t2[0], gt[0]]
 
-        for scan_idx in xrange(5):
-            slices_by_mode[scan_idx] = io.imread(scans[scan_idx], plugin='simpleitk').astype(float)
-        for mode_ix in xrange(slices_by_mode.shape[0]):         # modes 1 thru 5
-            for slice_ix in xrange(slices_by_mode.shape[1]):
-                # slices 1 thru 155
-                slices_by_slice[slice_ix][mode_ix] = slices_by_mode[mode_ix][slice_ix]
-        return slices_by_mode, slices_by_slice
+        for scan_idx in xrange(4):
+            slices_by_mode[scan_idx] = io.imread(scans[scan_idx], plugin='simpleitk')
+        gt_mask = io.imread(scans[4], plugin='simpleitk').astype(np.uint8)
+        slices_by_slice = slices_by_mode.transpose((1, 0, 2, 3))
+        return slices_by_mode, slices_by_slice, gt_mask
+
+    @property
+    def normed_slices(self):
+        # only 'norm' / 'n4' modes need the z-scored volume, build it on first use
+        if self._normed_slices is None:
+            self._normed_slices = self.norm_slices()
+        return self._normed_slices
 
     def norm_slices(self):
         '''
         normalizes each slice in self.slices_by_slice, excluding gt
         subtracts mean and div by std dev for each slice
-        clips top and bottom one percent of pixel intensities
-        if n4itk == True, will apply n4itk bias correction to T1 and T1c images
+        if clip_pct is set, clips pixel intensities of each slice to those percentiles
+        if brain_mask is True, statistics only use brain (non-zero) pixels
+        all 155x4 slices are normalized in one vectorized pass
         '''
         print 'Normalizing slices...'
-        normed_slices = np.zeros((155, 5, 240, 240))
-        for slice_ix in xrange(155):
-            normed_slices[slice_ix][-1] = self.slices_by_slice[slice_ix][-1]
-            for mode_ix in xrange(4):
-                normed_slices[slice_ix][mode_ix] = self._normalize(self.slices_by_slice[slice_ix][mode_ix])
+        slices = self.slices_by_slice
+        mask = slices > 0 if self.brain_mask else None
+
+        if self.clip_pct is not None:
+            if mask is None:
+                b, t = np.percentile(slices, self.clip_pct, axis=(2, 3), keepdims=True)
+            else:
+                b, t = np.nanpercentile(np.where(mask, slices, np.nan), self.clip_pct,
+                                        axis=(2, 3), keepdims=True)
+            slices = np.clip(slices, b.astype(np.float32), t.astype(np.float32))
+
+        normed_slices = self._normalize(slices, mask)
         print 'Done.'
         return normed_slices
 
-    def _normalize(self, slice):
+    def _normalize(self, slices, mask=None):
         '''
-        INPUT:  (1) a single slice of any given modality (excluding gt)
-                (2) index of modality assoc with slice (0=flair, 1=t1, 2=t1c, 3=t2)
-        OUTPUT: normalized slice
+        INPUT:  (1) array of slices (..., 240, 240) of any modality (excluding gt)
+                (2) optional bool array of the same shape selecting the pixels
+                    the mean and std dev are computed over
+        OUTPUT: float32 array of normalized slices, slices with zero std dev
+                are returned unchanged. with a mask the background is set to 0
         '''
-        # b, t = np.percentile(slice, (0.5, 99.5))
-        # slice = np.clip(slice, b, t)
-        if np.std(slice) == 0:
-            return slice
+        if mask is None:
+            mean = slices.mean(axis=(-2, -1), dtype=np.float64, keepdims=True)
+            std = slices.std(axis=(-2, -1), dtype=np.float64, keepdims=True)
         else:
-            return (slice - np.mean(slice)) / np.std(slice)
+            count = np.maximum(mask.sum(axis=(-2, -1), keepdims=True), 1)
+            mean = np.where(mask, slices, 0).sum(axis=(-2, -1), dtype=np.float64,
+                                                 keepdims=True) / count
+            sq_dev = np.where(mask, (slices - mean.astype(np.float32)) ** 2, 0)
+            std = np.sqrt(sq_dev.sum(axis=(-2, -1), dtype=np.float64, keepdims=True) / count)
+
+        valid = std > 0
+        mean = np.where(valid, mean, 0).astype(np.float32)
+        std = np.where(valid, std, 1).astype(np.float32)
+        normed = (slices - mean) / std
+        if mask is not None:
+            normed = np.where(mask | ~valid, normed, 0)
+        return normed.astype(np.float32, copy=False)
+
+    def tumour_slices(self, crop_bd):
+        '''
+        OUTPUT: the slices with tumour in the gt, cropped and max normalized per
+                modality the same way as the 'reg' mode of save_patient
+                (1) images (n, 184, 184, 4) float32
+                (2) labels (n, 184, 184) uint8
+                (3) slice indices (n,)
+        '''
+        slice_ix = np.flatnonzero(self.gt.reshape(self.gt.shape[0], -1).max(1))
+        strips = self.slices_by_slice[slice_ix]
+        strips /= strips.max(axis=(2, 3), keepdims=True)
+        images = strips[:, :, crop_bd:224 - crop_bd, crop_bd:224 - crop_bd].transpose((0, 2, 3, 1))
+        labels = self.gt[slice_ix, crop_bd:224 - crop_bd, crop_bd:224 - crop_bd]
+        return np.ascontiguousarray(images), labels, slice_ix
 
     def save_patient(self, reg_norm_n4, patient_num, modality,
                      dst_dir,
@@ -105,13 +167,21 @@ class BrainPipeline(object):
         print 'Saving scans fo` patient {}...'.format(patient_num)
 
         mod_dict = dict((v, k) for k, v in config.MODALITY_DICT.iteritems())
-        if not os.path.exists(dst_dir):
-            os.makedirs(dst_dir)
+        _makedirs(dst_dir)
+
+        # +++++++++++++++ STORE all modes in one H5 per patient ++++++++++++++
+        if reg_norm_n4 == 'reg' and save_mode == 'store':
+            images, labels, slice_ix = self.tumour_slices(crop_bd)
+            ids = [h5_store.slice_id(patient_num, i) for i in slice_ix]
+            with h5_store.H5SliceWriter(os.path.join(dst_dir,
+                                                     'HGG_patient_{}.h5'.format(patient_num))) as writer:
+                writer.append(images, labels, ids)
+            return
 
         if reg_norm_n4 == 'reg':
             for slice_ix in xrange(155):
 
-                gt_strip = self.slices_by_slice[slice_ix][4]
+                gt_strip = self.gt[slice_ix]
                 if np.max(gt_strip) != 0:
                     h5f = h5py.File(dst_dir + 'HGG_patient_{}_{}_.h5'.format(patient_num,
                                                                              slice_ix), 'w')
@@ -144,7 +214,7 @@ class BrainPipeline(object):
         elif reg_norm_n4 == 'norm':
             for slice_ix in xrange(155):
                 strip = self.normed_slices[slice_ix][modality_idx]
-                gt_strip = self.normed_slices[slice_ix][4]
+                gt_strip = self.gt[slice_ix]
                 if np.max(gt_strip) != 0:  # set values < 1
                     strip /= np.max(strip)
 
@@ -161,7 +231,7 @@ class BrainPipeline(object):
         else:
             for slice_ix in xrange(155):
                 strip = self.normed_slices[slice_ix][modality_idx]
-                gt_strip = self.normed_slices[slice_ix][4]
+                gt_strip = self.gt[slice_ix]
                 # if np.max(strip) != 0:  # set values < 1
                 #     strip /= np.max(strip)
                 # if np.min(strip) <= -1:  # set values > -1
@@ -172,17 +242,86 @@ class BrainPipeline(object):
                               strip)
 
 
-def save_patient_slices(patients, img_mode, modality,
-                        dst_dir,
-                        clip_idx, crop_bd,
-                        save_mode):
-
-    for patient_num, path in enumerate(patients):
+def _save_one_patient(job):
+    '''
+    pool worker: builds the BrainPipeline of one patient and saves its slices.
+    returns (patient_num, path, error) where error is None on success and the
+    formatted traceback otherwise, so one corrupt patient does not kill the run
+    '''
+    patient_num, path, img_mode, modality, dst_dir, clip_idx, crop_bd, save_mode = job
+    try:
         a = BrainPipeline(path)
         a.save_patient(img_mode, patient_num, modality,
                        dst_dir,
                        clip_idx, crop_bd,
                        save_mode)
+    except Exception:
+        return patient_num, path, traceback.format_exc()
+    return patient_num, path, None
+
+
+def save_patient_slices(patients, img_mode, modality,
+                        dst_dir,
+                        clip_idx, crop_bd,
+                        save_mode, n_workers=1):
+    '''
+    n_workers == 1 keeps the serial behaviour, otherwise patients are
+    ingested by a process pool of n_workers (None -> one per core).
+    returns the list of (patient_num, path, traceback) that failed
+    '''
+    # patients are numbered in the order of their dir names, not the glob order,
+    # and the name of every number is recorded for split_manifest
+    patients = sorted(patients)
+    split_manifest.write_patient_index(patients)
+    jobs = [(patient_num, path, img_mode, modality, dst_dir, clip_idx, crop_bd, save_mode)
+            for patient_num, path in enumerate(patients)]
+    n_patients = len(jobs)
+
+    pool = None
+    if n_workers == 1:
+        results = itertools.imap(_save_one_patient, jobs)
+    else:
+        pool = multiprocessing.Pool(n_workers, maxtasksperchild=1)
+        results = pool.imap_unordered(_save_one_patient, jobs)
+
+    failed = []
+    start_time = time.time()
+    for done, (patient_num, path, error) in enumerate(results, 1):
+        if error is None:
+            print '[{}/{}] patient {} done ({:.1f}s elapsed)'.format(done, n_patients, patient_num,
+                                                                   time.time() - start_time)
+        else:
+            print '[{}/{}] patient {} FAILED : {}'.format(done, n_patients, patient_num, path)
+            print error
+            failed.append((patient_num, path, error))
+        sys.stdout.flush()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print '{} patients saved, {} failed.'.format(n_patients - len(failed), len(failed))
+    for patient_num, path, _ in failed:
+        print '    patient {} : {}'.format(patient_num, path)
+    return failed
+
+
+def save_patient_store(patients, dst_store, crop_bd, n_workers=1):
+    '''
+    writes the tumour slices of all patients into the single H5 store dst_store
+    (see h5_store). patients are written to one store each by the pool, then merged
+    '''
+    tmp_dir = os.path.splitext(dst_store)[0] + '_patients/'
+    failed = save_patient_slices(patients, 'reg', None,
+                                 tmp_dir,
+                                 None, crop_bd,
+                                 'store', n_workers=n_workers)
+    failed_nums = set(patient_num for patient_num, _, _ in failed)
+    h5_store.merge_stores([os.path.join(tmp_dir, 'HGG_patient_{}.h5'.format(patient_num))
+                           for patient_num in xrange(len(patients))
+                           if patient_num not in failed_nums],
+                          dst_store)
+    return failed
 
 
 if __name__ == '__main__':
@@ -196,5 +335,8 @@ if __name__ == '__main__':
                         config.MODALITY,
                         config.DST_JPG_DIR,  # -> Root dir for saving
                         PER, CROP_BUNDRY,   # -> dst image specs
-                        save_mode='all')
+                        save_mode='all',
+                        n_workers=config.INGEST_WORKERS)
     # save_mode='single')  -> 't1' or 't2'
+    # save_patient_store(glob(config.SRC_NIFTY_DIR), config.H5_STORE, CROP_BUNDRY,
+    #                    n_workers=config.INGEST_WORKERS)  -> one consolidated H5
@@ -4,15 +4,18 @@
 from __future__ import division, print_function, absolute_import
 import tensorflow as tf
 import sys
+import json
+import multiprocessing
 import numpy as np
 import cv2
 import os
 from sklearn.utils import shuffle
-from sklearn.model_selection import train_test_split
 
 
 import config
 import h5py
+import h5_store
+import split_manifest
 
 
 def _int64_feature(value):
@@ -23,9 +26,50 @@ def _bytes_feature(value):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
 
+# how images / labels are stored, recorded in index.json for batch_inputs
+RECORD_FORMAT = {'compression': config.TFRECORD_COMPRESSION,
+                 'image_dtype': config.TFRECORD_IMAGE_DTYPE,
+                 'label_dtype': config.TFRECORD_LABEL_DTYPE}
+
+
+def _writer_options(fmt=RECORD_FORMAT):
+    if fmt['compression'] is None:
+        return None
+    return tf.python_io.TFRecordOptions(
+        getattr(tf.python_io.TFRecordCompressionType, fmt['compression']))
+
+
+def encode_image(img, image_dtype):
+    '''
+    'uint16' quantizes the max normalized 'reg' images, [0, 1] -> [0, 65535]
+    '''
+    if image_dtype == 'uint16':
+        if not (0 <= img.min() and img.max() <= 1):
+            raise ValueError("uint16 images need values in [0, 1], got [{}, {}]".format(img.min(),
+                                                                                      img.max()))
+        return np.round(img * 65535).astype(np.uint16)
+    return img.astype(image_dtype)
+
+
+def _serialize_example(img, lbl, ID, fmt=RECORD_FORMAT):
+
+    img = encode_image(img, fmt['image_dtype'])
+    lbl = lbl.astype(fmt['label_dtype'])
+
+    # Create a feature
+    feature = {
+        'train/image': _bytes_feature(tf.compat.as_bytes(img.tostring())),
+        'train/label': _bytes_feature(tf.compat.as_bytes(lbl.tostring())),
+        'train/id': _bytes_feature(tf.compat.as_bytes(ID))}
+
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
+
+    return example.SerializeToString()
+
+
 def write_record(imgs, lbls, IDs, tfrecord_name='./train.tfrecords', lbl='train'):
 
-    writer = tf.python_io.TFRecordWriter(tfrecord_name)
+    writer = tf.python_io.TFRecordWriter(tfrecord_name, options=_writer_options())
 
     n_obs = imgs.shape[0]
     for i in range(n_obs):
@@ -33,61 +77,74 @@ def write_record(imgs, lbls, IDs, tfrecord_name='./train.tfrecords', lbl='train'
             print('{} data: {}/{}'.format(lbl, i, n_obs))
             sys.stdout.flush()
 
-        # Load the image
-        img = imgs[i, :, :, :]
-        lbl = lbls[i, :, :]
-        ID = IDs[i]
+        writer.write(_serialize_example(imgs[i, :, :, :], lbls[i, :, :], IDs[i]))
 
-        # Create a feature
-        feature = {
-            'train/image': _bytes_feature(tf.compat.as_bytes(img.tostring())),
-            'train/label': _bytes_feature(tf.compat.as_bytes(lbl.tostring())),
-            'train/id': _bytes_feature(tf.compat.as_bytes(ID))}
+    writer.close()
+    sys.stdout.flush()
 
-        example = tf.train.Example(features=tf.train.Features(feature=feature))
 
-        writer.write(example.SerializeToString())
+def write_record_stream(examples, n_obs, tfrecord_name='./train.tfrecords', lbl='train'):
+    '''
+    examples: iterable of (img, lbl, ID), serialized one at a time as it is consumed
+    '''
+    writer = tf.python_io.TFRecordWriter(tfrecord_name, options=_writer_options())
+
+    for i, (img, label, ID) in enumerate(examples):
+        if not i % 100:
+            print('{} data: {}/{}'.format(lbl, i, n_obs))
+            sys.stdout.flush()
+
+        writer.write(_serialize_example(img, label, ID))
 
     writer.close()
     sys.stdout.flush()
 
 
-def load_data(path, do_test=False):
-    images = []
-    labels = []
-    ids = []
-    print('Reading images')
-
+def read_example(path, i):
+    '''
+    reads one HGG_patient_{n}_{slice}_.h5 file
+    returns image (184, 184, 4) float32, label (184, 184) int32, ID
+    '''
     mod_dict = dict((v, k) for k, v in config.MODALITY_DICT.iteritems())
 
-    for i in os.listdir(path):
-        tmp_list = i.split('_')
-        patient_num = tmp_list[2]
-        slice_ix = tmp_list[3]
+    tmp_list = i.split('_')
+    patient_num = tmp_list[2]
+    slice_ix = tmp_list[3]
 
-        h5f = h5py.File(os.path.join(path, i), 'r')
+    h5f = h5py.File(os.path.join(path, i), 'r')
 
-        # +++++++++++++++++++++++++ IMAGE +++++++++++++++++++++++++
-        mod_images = []
-        for mod in range(4):
-            dataset_name = '{}_{}_{}'.format(mod_dict[mod],
-                                             patient_num, slice_ix)
-            img = h5f[dataset_name][:]
-            mod_images.append(img)
+    # +++++++++++++++++++++++++ IMAGE +++++++++++++++++++++++++
+    mod_images = []
+    for mod in range(4):
+        dataset_name = '{}_{}_{}'.format(mod_dict[mod],
+                                         patient_num, slice_ix)
+        img = h5f[dataset_name][:]
+        mod_images.append(img)
 
-        images.append(mod_images)
+    img = np.stack(mod_images, axis=-1).astype(np.float32)
 
-        # +++++++++++++++++++++++++ LABEL +++++++++++++++++++++++++
-        lbl = h5f['gt_{}_{}'.format(patient_num, slice_ix)][:]
-        labels.append(lbl)
+    # +++++++++++++++++++++++++ LABEL +++++++++++++++++++++++++
+    lbl = h5f['gt_{}_{}'.format(patient_num, slice_ix)][:].astype(np.int32)
+
+    h5f.close()
 
-        h5f.close()
+    # +++++++++++++++++++++++++++ ID ++++++++++++++++++++++++++
+    return img, lbl, i
 
-        # +++++++++++++++++++++++++++ ID ++++++++++++++++++++++++++
-        ids.append(i)
+
+def load_data(path, do_test=False):
+    images = []
+    labels = []
+    ids = []
+    print('Reading images')
+
+    for i in os.listdir(path):
+        img, lbl, ID = read_example(path, i)
+        images.append(img)
+        labels.append(lbl)
+        ids.append(ID)
 
     images = np.array(images, dtype=np.float32)
-    images = images.transpose((0, 2, 3, 1))
     labels = np.array(labels, dtype=np.int32)
     ids = np.array(ids)
 
@@ -99,14 +156,20 @@ def load_data(path, do_test=False):
 
 def creat_tf_records():
 
-    images_data, labels_data, ids_data = load_data(config.H5_SRC)
+    if config.USE_H5_STORE:
+        images_data, labels_data, ids_data = h5_store.load_store(config.H5_STORE)
+    else:
+        images_data, labels_data, ids_data = load_data(config.H5_SRC)
     print('Data Loaded.')
     print(' Data : ', images_data.shape, '\n')
 
-    train_images, test_images, train_labels, test_labels, \
-        train_ids, test_ids = train_test_split(images_data, labels_data, ids_data,
-                                               test_size=config.TEST_SPLIT,
-                                               random_state=42)
+    manifest = split_manifest.load_or_create_manifest(ids_data)
+    train_mask, test_mask = split_manifest.split_masks(ids_data, manifest,
+                                                       config.TEST_FOLD, config.TRAIN_FOLDS)
+    train_images, train_labels, train_ids = \
+        images_data[train_mask], labels_data[train_mask], ids_data[train_mask]
+    test_images, test_labels, test_ids = \
+        images_data[test_mask], labels_data[test_mask], ids_data[test_mask]
 
     print('Train data : ')
     print(train_images.shape)
@@ -122,7 +185,7 @@ def creat_tf_records():
     train_images, train_labels, train_ids = shuffle(train_images, train_labels, train_ids)
     test_images, test_labels, test_ids = shuffle(test_images, test_labels, test_ids)
 
-    TFRECORD_ROOT = './record/'
+    TFRECORD_ROOT = config.TFRECORD_ROOT
     if not os.path.exists(TFRECORD_ROOT):
         os.makedirs(TFRECORD_ROOT)
 
@@ -134,6 +197,106 @@ def creat_tf_records():
     write_record(test_images, test_labels, test_ids,
                  tfrecord_name=TFRECORD_ROOT + 'test.tfrecords', lbl='test')
 
+    write_index(TFRECORD_ROOT, {'train': [('train.tfrecords', len(train_ids))],
+                                'test': [('test.tfrecords', len(test_ids))]})
+
+
+def iter_examples(keys, store=None, batch_size=64):
+    '''
+    yields (img, lbl, ID) for the given keys, which are file names in
+    config.H5_SRC, or indices into the H5 store when one is given.
+    only one file / one batch of the store is in memory at a time
+    '''
+    if store is None:
+        for i in keys:
+            yield read_example(config.H5_SRC, i)
+    else:
+        for images, labels, ids in store.iter_batches(batch_size, keys):
+            for img, lbl, ID in zip(images, labels.astype(np.int32), ids):
+                yield img, lbl, ID
+
+
+def shard_name(lbl, shard_ix, n_shards):
+    if n_shards == 1:
+        return '{}.tfrecords'.format(lbl)
+    return '{}-{:05d}-of-{:05d}.tfrecords'.format(lbl, shard_ix, n_shards)
+
+
+def write_index(tfrecord_root, shards):
+    '''
+    shards: {'train': [(file name, n examples), ...], 'test': [...]}
+    written next to the records, read back by batch_inputs.record_files
+    '''
+    index = dict((lbl, {'files': [os.path.basename(name) for name, _ in files],
+                        'counts': [n for _, n in files]})
+                 for lbl, files in shards.items())
+    index.update(RECORD_FORMAT)
+    with open(os.path.join(tfrecord_root, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+
+def _write_shard(job):
+    keys, tfrecord_name, lbl = job
+    # h5py handles do not survive the fork, every worker opens its own store
+    store = h5_store.H5SliceStore(config.H5_STORE) if config.USE_H5_STORE else None
+    write_record_stream(iter_examples(keys, store), len(keys),
+                        tfrecord_name=tfrecord_name, lbl=lbl)
+    if store is not None:
+        store.close()
+    return tfrecord_name, len(keys)
+
+
+def creat_tf_records_streaming(n_shards=config.TFRECORD_SHARDS,
+                               n_workers=config.TFRECORD_WORKERS):
+    '''
+    same output as creat_tf_records, but train / test membership is assigned
+    on the file list before any pixel is read and records are written while
+    the examples are read, so memory does not grow with the dataset.
+    slices of folds outside config.TRAIN_FOLDS / config.TEST_FOLD are never read.
+    each split is written as n_shards files by a pool of n_workers processes
+    (None -> one per core), listed in TFRECORD_ROOT/index.json
+    '''
+    if config.USE_H5_STORE:
+        with h5_store.H5SliceStore(config.H5_STORE) as store:
+            ids = np.asarray(store.ids[:])
+        keys = np.arange(len(ids))
+    else:
+        ids = keys = np.array(sorted(os.listdir(config.H5_SRC)))
+    print('Examples : ', len(keys), '\n')
+
+    manifest = split_manifest.load_or_create_manifest(ids)
+    train_mask, test_mask = split_manifest.split_masks(ids, manifest,
+                                                       config.TEST_FOLD, config.TRAIN_FOLDS)
+    train_keys = shuffle(keys[train_mask], random_state=config.SPLIT_SEED)
+    test_keys = shuffle(keys[test_mask], random_state=config.SPLIT_SEED)
+
+    TFRECORD_ROOT = config.TFRECORD_ROOT
+    if not os.path.exists(TFRECORD_ROOT):
+        os.makedirs(TFRECORD_ROOT)
+
+    jobs = []
+    for lbl, split_keys in (('train', train_keys), ('test', test_keys)):
+        for shard_ix in range(n_shards):
+            jobs.append((split_keys[shard_ix::n_shards],
+                         TFRECORD_ROOT + shard_name(lbl, shard_ix, n_shards),
+                         '{} {}/{}'.format(lbl, shard_ix + 1, n_shards)))
+
+    if n_workers == 1:
+        written = [_write_shard(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        written = pool.map(_write_shard, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+
+    write_index(TFRECORD_ROOT, {'train': written[:n_shards],
+                                'test': written[n_shards:]})
+    print('{} train / {} test examples written to {} shards each'.format(
+        len(train_keys), len(test_keys), n_shards))
+
 
 if __name__ == '__main__':
-    creat_tf_records()
+    if config.STREAM_TFRECORDS:
+        creat_tf_records_streaming()
+    else:
+        creat_tf_records()
@@ -9,11 +9,12 @@ import cv2
 import os
 import glob
 from sklearn.utils import shuffle
-from sklearn.model_selection import train_test_split
 
 
 import config
 import h5py
+import h5_store
+import split_manifest
 
 
 def _int64_feature(value):
@@ -101,14 +102,20 @@ def load_data(path, do_test=False):
 
 def creat_tf_records():
 
-    images_data, labels_data, ids_data = load_data(config.H5_SRC)
+    if config.USE_H5_STORE:
+        images_data, labels_data, ids_data = h5_store.load_store(config.H5_STORE)
+    else:
+        images_data, labels_data, ids_data = load_data(config.H5_SRC)
     print('Data Loaded.')
     print(' Data : ', images_data.shape, '\n')
 
-    train_images, test_images, train_labels, test_labels, \
-        train_ids, test_ids = train_test_split(images_data, labels_data, ids_data,
-                                               test_size=config.TEST_SPLIT,
-                                               random_state=42)
+    manifest = split_manifest.load_or_create_manifest(ids_data)
+    train_mask, test_mask = split_manifest.split_masks(ids_data, manifest,
+                                                       config.TEST_FOLD, config.TRAIN_FOLDS)
+    train_images, train_labels, train_ids = \
+        images_data[train_mask], labels_data[train_mask], ids_data[train_mask]
+    test_images, test_labels, test_ids = \
+        images_data[test_mask], labels_data[test_mask], ids_data[test_mask]
 
     print('Train data : ')
     print(train_images.shape)
@@ -6,31 +6,22 @@ import tensorflow as tf
 import os
 
 import config
+import batch_inputs
 
 
 def inputs(record_file, batch_size=32, do_test=False):
 
-    feature = {'train/image': tf.FixedLenFeature([], tf.string),
-               'train/label': tf.FixedLenFeature([], tf.string),
-               'train/id': tf.FixedLenFeature([], tf.string)}
+    # records may be compressed / stored with compact dtypes, see batch_inputs
+    fmt = batch_inputs.record_format()
 
     # Create a list of filenames and pass it to a queue
     filename_queue = tf.train.string_input_producer(record_file,
                                                     num_epochs=config.N_EPOCHS
                                                     if not do_test else 1)
 
-    reader = tf.TFRecordReader()
+    reader = tf.TFRecordReader(options=batch_inputs.reader_options(fmt))
     _, serialized_example = reader.read(filename_queue)
-    features = tf.parse_single_example(serialized_example, features=feature)
-
-    # Convert the image data from string back to the numbers
-    image = tf.decode_raw(features['train/image'], tf.float32)
-    # label = tf.decode_raw(features['train/label'], tf.float32)
-    label = tf.decode_raw(features['train/label'], tf.int32)
-    ID = features['train/id']
-
-    image = tf.reshape(image, [config.ORIG_SIZE, config.ORIG_SIZE, 4])
-    label = tf.reshape(label, [config.ORIG_SIZE, config.ORIG_SIZE])
+    image, label, ID = batch_inputs.decode_example(serialized_example, fmt)
 
     # Ensure that the random shuffling has good mixing properties.
     min_fraction_of_examples_in_queue = 0.4
@@ -54,7 +45,7 @@ def inputs(record_file, batch_size=32, do_test=False):
 if __name__ == '__main__':
 
     TEST_BATCH_SIZE = 10
-    images, labels, ids = inputs(['./record/train.tfrecords'],
+    images, labels, ids = inputs(batch_inputs.record_files('train'),
                                  TEST_BATCH_SIZE, True)
 
     with tf.Session() as sess:
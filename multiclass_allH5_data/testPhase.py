@@ -6,8 +6,7 @@ import numpy as np
 import config
 import batch_inputs
 import evaluation
-import inference_gray
-inference = inference_gray
+from main_placeholder_multiclass import build_model
 
 
 IMAGE_SIZE = 176
@@ -18,43 +17,38 @@ FLAGS = tf.app.flags.FLAGS
 def test():
 
     tf.reset_default_graph()
+    input_fn = batch_inputs.dataset_inputs if FLAGS.use_tf_data else batch_inputs.inputs
     with tf.Graph().as_default():
 
         # ++++++++++++++++++++++++ TESTING INPUT LAODING ++++++++++++++++++++++++
-        x_test, y_test, id_test = batch_inputs.inputs(['./record/test.tfrecords'],
-                                                      FLAGS.batch_size, True)
-        y_test = tf.one_hot(y_test, FLAGS.num_class)
-        x_test = tf.image.resize_image_with_crop_or_pad(x_test, IMAGE_SIZE,
-                                                        IMAGE_SIZE)
-        y_test = tf.image.resize_image_with_crop_or_pad(y_test, IMAGE_SIZE,
-                                                        IMAGE_SIZE)
+        x_test, y_test, id_test = input_fn(batch_inputs.record_files('test'),
+                                           FLAGS.batch_size, True)
+        x_test, y_test = batch_inputs.crop_batch(x_test, y_test, IMAGE_SIZE,
+                                                 FLAGS.sparse_labels)
         # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-        is_training = tf.placeholder(tf.bool, name='is_training')
+        # python False : only the frozen statistics batch norm path is built
+        is_training = False
         keep_prob = tf.placeholder(tf.float32, name="keep_probabilty")
         images = tf.placeholder(tf.float32,
                                 shape=[None,
                                        FLAGS.image_h, FLAGS.image_w, FLAGS.image_c])
-        labels = tf.placeholder(tf.int64,
-                                [None,
-                                 FLAGS.image_h, FLAGS.image_w, FLAGS.num_class])
+        if FLAGS.sparse_labels:
+            labels = tf.placeholder(tf.uint8,
+                                    [None,
+                                     FLAGS.image_h, FLAGS.image_w])
+        else:
+            labels = tf.placeholder(tf.int64,
+                                    [None,
+                                     FLAGS.image_h, FLAGS.image_w, FLAGS.num_class])
         # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
         print('++++++++ Mode building starts here +++++++++')
-        if FLAGS.model == "basic":
-            logits = inference.inference_basic(images, is_training)
-        elif FLAGS.model == "extended":
-            logits = inference.inference_extended(images, is_training)
-        elif FLAGS.model == "basic_dropout":
-            logits = inference.inference_basic_dropout(images, is_training, keep_prob)
-        elif FLAGS.model == "extended_dropout":
-            logits = inference.inference_extended_dropout(images, is_training, keep_prob)
-        else:
-            raise ValueError("The selected model does not exist")
+        logits = build_model(images, is_training, keep_prob)
 
         sfm_logits = tf.nn.softmax(logits)
         class_pred = tf.argmax(logits, axis=3)
-        y_test_argmax = tf.argmax(y_test, axis=3)
+        y_test_argmax = y_test if FLAGS.sparse_labels else tf.argmax(y_test, axis=3)
 
         saver = tf.train.Saver()
 
@@ -78,7 +72,6 @@ def test():
 
             test_feed_dict = {images: test_img_batch,
                               labels: test_lbl_batch,
-                              is_training: True,
                               keep_prob: 1.0}
 
             class_pred_val, sfm_logits_val, pred = sess.run([class_pred, sfm_logits, logits], feed_dict=test_feed_dict)
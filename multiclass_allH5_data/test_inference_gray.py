@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Graph checks of inference_gray, run with the TF version used for training
+
+    python test_inference_gray.py
+"""
+
+from __future__ import division, print_function, absolute_import
+import re
+import numpy as np
+import tensorflow as tf
+
+import config  # defines the FLAGS inference_gray reads
+import inference_gray
+
+# the layers of the four hand-written models inference_segnet replaced
+# (inference_basic, inference_basic_dropout, inference_extended,
+# inference_extended_dropout), in the order they were built
+ORIGINAL_LAYERS = {
+    'basic': """
+        norm1 conv1 pool1 conv2 pool2 conv3 pool3 conv4 pool4
+        unpool_4 conv_decode4 unpool_3 conv_decode3 unpool_2 conv_decode2 unpool_1 conv_decode1
+        conv_classifier""",
+    'basic_dropout': """
+        norm1 conv1 pool1 dropout1 conv2 pool2 dropout2 conv3 pool3 dropout3 conv4 pool4
+        unpool_4 conv_decode4 decoder_dropout3 unpool_3 conv_decode3 decoder_dropout2
+        unpool_2 conv_decode2 decoder_dropout1 unpool_1 conv_decode1
+        conv_classifier""",
+    'extended': """
+        conv1_1 conv1_2 pool1 conv2_1 conv2_2 pool2 conv3_1 conv3_2 conv3_3 pool3
+        conv4_1 conv4_2 conv4_3 pool4 conv5_1 conv5_2 conv5_3 pool5
+        unpool_5 conv_decode5_1 conv_decode5_2 conv_decode5_3
+        unpool_4 conv_decode4_1 conv_decode4_2 conv_decode4_3
+        unpool_3 conv_decode3_1 conv_decode3_2 conv_decode3_3
+        unpool_2 conv_decode2_1 conv_decode2_2 unpool_1 conv_decode1_1 conv_decode1_2
+        conv_classifier""",
+    'extended_dropout': """
+        conv1_1 conv1_2 pool1 dropout1 conv2_1 conv2_2 pool2 dropout2
+        conv3_1 conv3_2 conv3_3 pool3 dropout3 conv4_1 conv4_2 conv4_3 pool4 dropout4
+        conv5_1 conv5_2 conv5_3 pool5 dropout5
+        unpool_5 conv_decode5_1 conv_decode5_2 conv_decode5_3 dropout4_decode
+        unpool_4 conv_decode4_1 conv_decode4_2 conv_decode4_3 dropout3_decode
+        unpool_3 conv_decode3_1 conv_decode3_2 conv_decode3_3 dropout2_decode
+        unpool_2 conv_decode2_1 conv_decode2_2 dropout1_deconv
+        unpool_1 conv_decode1_1 conv_decode1_2
+        conv_classifier""",
+}
+# top level name scopes of the layers, not the casts and 1 - keep_prob in between
+LAYER_SCOPE = re.compile(r'^(norm|conv|pool|dropout|decoder_dropout|unpool)')
+
+
+class UnpoolTest(tf.test.TestCase):
+    # unpool_with_argmax_fused runs the private max_pool_grad_with_argmax op, whose
+    # argmax layout (batch offset or not, include_batch_in_index) follows the TF
+    # version : both unpoolings must agree, for more than one example per batch
+
+    def _unpool_both(self, shape):
+        with tf.Graph().as_default():
+            x = tf.constant(np.random.RandomState(0).permutation(np.prod(shape)).reshape(shape) + 1,
+                            dtype=tf.float32)
+            pool, ind = tf.nn.max_pool_with_argmax(x, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1],
+                                                   padding='SAME')
+            scatter = inference_gray.unpool_with_argmax(pool, ind, name='scatter', like=x)
+            fused = inference_gray.unpool_with_argmax_fused(pool, ind, like=x, name='fused')
+            weights = tf.constant(np.arange(np.prod(shape)).reshape(shape), dtype=tf.float32)
+            grads = [tf.gradients(tf.reduce_sum(up * weights), pool)[0] for up in [scatter, fused]]
+            with self.test_session() as sess:
+                return sess.run([x, pool, scatter, fused] + grads)
+
+    def _check(self, shape):
+        x, pool, scatter, fused, scatter_grad, fused_grad = self._unpool_both(shape)
+        self.assertEqual(scatter.shape, x.shape)
+        self.assertAllEqual(scatter, fused)
+        self.assertAllEqual(scatter_grad, fused_grad)
+        # every example gets back its own maxima, in place
+        for b in range(shape[0]):
+            self.assertEqual(scatter[b].sum(), pool[b].sum())
+        self.assertAllEqual(scatter[scatter != 0], x[scatter != 0])
+
+    def test_batch(self):
+        self._check([3, 8, 8, 4])
+
+    def test_odd_size(self):
+        # 11 pools to 6 and must unpool back to 11
+        self._check([3, 11, 11, 2])
+
+
+class ModelPresetTest(tf.test.TestCase):
+    # the presets of the original models build their layers, under their op
+    # and variable names : their checkpoints restore and their graphs match
+
+    def _layers(self, model):
+        with tf.Graph().as_default() as graph:
+            images = tf.placeholder(tf.float32, [None, 32, 32, 4], name='images')
+            is_training = tf.placeholder(tf.bool, name='is_training')
+            keep_prob = tf.placeholder(tf.float32, name='keep_prob')
+            inference_gray.inference_segnet(images, is_training, keep_prob,
+                                            **inference_gray.model_spec(model))
+            layers = []
+            for op in graph.get_operations():
+                scope = op.name.split('/')[0]
+                if LAYER_SCOPE.match(scope) and scope not in layers:
+                    layers.append(scope)
+            variables = set(v.op.name.split('/')[0] for v in tf.global_variables())
+        return layers, variables
+
+    def test_original_models(self):
+        for model, expected in ORIGINAL_LAYERS.items():
+            expected = expected.split()
+            layers, variables = self._layers(model)
+            self.assertEqual(layers, expected, model)
+            self.assertEqual(variables, set(l for l in expected if l.startswith('conv')), model)
+
+
+if __name__ == "__main__":
+    tf.test.main()
@@ -23,6 +23,14 @@ def training(loss):
         else:
             raise ValueError("optimizer was not recognized.")
 
+        if FLAGS.precision == "float16":
+            # float16 gradients underflow : scale the loss up, the gradients of the
+            # float32 master weights back down, skip steps that overflow
+            print("Running with dynamic loss scaling")
+            loss_scale_manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+                init_loss_scale=FLAGS.loss_scale, incr_every_n_steps=1000)
+            optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(optimizer, loss_scale_manager)
+
         train_op = optimizer.minimize(loss=loss, global_step=global_step)
         # optimizer, like 'SGD', 'Adam', 'Adagrad'
         #train_op = tf.contrib.layers.optimize_loss(loss, optimizer="SGD", global_step=global_step, learning_rate = 0.1)